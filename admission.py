@@ -0,0 +1,89 @@
+import asyncio
+import functools
+import logging
+import os
+
+from cache import TTLCache
+from metrics import Counter, Gauge
+from ratelimit import TokenBucket
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+# Admission settings: how many messages run at once, how many may wait, and
+# each user's sustained rate (messages per second) and burst (e.g. one album)
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUED = int(os.getenv("ADMISSION_MAX_QUEUED", "200"))
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "0.5"))
+ADMISSION_USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "10"))
+ADMISSION_NOTICE_INTERVAL = int(os.getenv("ADMISSION_NOTICE_INTERVAL", "30"))
+
+SLOW_DOWN_TEXT = "🐢 You are sending links too fast. Please slow down and try again in a moment."
+BUSY_TEXT = "⏳ The bot is very busy right now. Please try again in a minute."
+
+ADMISSION_REJECTED = Counter("bot_admission_rejected_total", "Messages rejected by admission control", ["reason"])
+ADMISSION_WAITING = Gauge("bot_admission_waiting", "Messages waiting for a handler slot")
+
+
+# Fair admission in front of an update handler. Every user has a token bucket,
+# so one user's album cannot take more than its share; admitted messages wait
+# in a bounded queue for one of max_in_flight slots, and when the queue is full
+# new messages are turned away instead of piling up.
+class AdmissionController:
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queued=ADMISSION_MAX_QUEUED,
+                 user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.user_buckets = TTLCache(maxsize=100000, ttl=3600)
+        self.notified = TTLCache(maxsize=100000, ttl=ADMISSION_NOTICE_INTERVAL)
+        self.waiting = 0
+        self._semaphore = None
+
+    def _user_bucket(self, user_id):
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, capacity=self.user_burst)
+            self.user_buckets.set(user_id, bucket)
+        return bucket
+
+    # Tell the user why the message was dropped, at most once per notice interval
+    async def _reject(self, update, reason, text):
+        ADMISSION_REJECTED.inc(reason=reason)
+        user_id = update.effective_user.id
+        if user_id in self.notified:
+            return
+        self.notified.set(user_id, True)
+        try:
+            await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Error sending admission notice to {user_id}: {e}")
+
+    # Wrap a handler so it only runs for admitted updates
+    def limit(self, handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+            if not self._user_bucket(update.effective_user.id).try_acquire():
+                return await self._reject(update, "rate_limited", SLOW_DOWN_TEXT)
+            if self._semaphore.locked() and self.waiting >= self.max_queued:
+                return await self._reject(update, "overloaded", BUSY_TEXT)
+
+            self.waiting += 1
+            ADMISSION_WAITING.inc()
+            try:
+                with span("admission_wait"):
+                    await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+                ADMISSION_WAITING.dec()
+            try:
+                return await handler(update, context)
+            finally:
+                self._semaphore.release()
+
+        return wrapper
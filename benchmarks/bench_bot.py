@@ -0,0 +1,313 @@
+"""Offline load test for the update handlers in bot.py.
+
+Drives /start, /connect, link messages (handle_message), /broadcast, /start
+during a group's flood wait and link messages through a multi-url shortener API
+through the real Application and handlers, against a local fake Telegram Bot
+API, a fake bisgram /api with configurable latency and error rate, and an
+in-memory MongoDB (see fakes.py). Nothing leaves the machine. For every scenario it
+reports updates/sec, p50/p95/p99 handler latency, handler errors and the calls
+made to Telegram, the shortener and Mongo. The seconds column includes the
+background work a scenario leaves, e.g. the shorten jobs of link messages.
+
+Run with: python benchmarks/bench_bot.py [--users N] [--messages N] ...
+(--help lists the knobs). Telegram send limits are lifted unless SEND_RATE,
+SEND_CHAT_RATE or SEND_CHAT_BURST are set, so the scenarios measure the bot itself.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import string
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from fakes import FakeShortener, FakeTelegram, ServerThread, fake_batch_backend, install_memory_mongo  # noqa: E402
+
+TOKEN = "123456:bench"
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+FLOODED_GROUP_ID = -1001000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=500, help="simulated users (default 500)")
+    parser.add_argument("--messages", type=int, default=2000, help="link messages to send (default 2000)")
+    parser.add_argument("--links", type=int, default=4, help="max Terabox links per message (default 4)")
+    parser.add_argument("--distinct-links", type=int, default=3000,
+                        help="size of the Terabox key pool, smaller means more cache hits (default 3000)")
+    parser.add_argument("--invalid-keys", type=float, default=0.05,
+                        help="share of users connecting an invalid api key (default 0.05)")
+    parser.add_argument("--concurrency", type=int, default=64, help="updates processed at once (default 64)")
+    parser.add_argument("--shortener-latency", type=float, default=0.05,
+                        help="mean bisgram latency in seconds (default 0.05)")
+    parser.add_argument("--shortener-error-rate", type=float, default=0.0,
+                        help="share of bisgram calls answering HTTP 500 (default 0)")
+    parser.add_argument("--telegram-latency", type=float, default=0.0,
+                        help="mean Telegram API latency in seconds (default 0)")
+    parser.add_argument("--blocked", type=float, default=0.02,
+                        help="share of users who blocked the bot before the broadcast (default 0.02)")
+    parser.add_argument("--flood-wait", type=int, default=5,
+                        help="retry_after of the group flood wait in the flood scenario (default 5)")
+    parser.add_argument("--shortener-batch", type=int, default=4,
+                        help="urls per call of the multi-url API in the batch scenario (default 4)")
+    parser.add_argument("--scenarios", default="start,connect,message,broadcast,flood,batch",
+                        help="comma separated scenarios to run, in order (default all)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the bot's warnings and errors")
+    return parser.parse_args()
+
+
+# --- Update builders ------------------------------------------------------------
+
+class Updates:
+    def __init__(self, bot):
+        self.bot = bot
+        self.ids = iter(range(1, 10 ** 9))
+
+    def _message(self, user_id, **fields):
+        update_id = next(self.ids)
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"},
+            **fields,
+        }
+        return Update.de_json({'update_id': update_id, 'message': message}, self.bot)
+
+    def command(self, user_id, text):
+        length = len(text.split(" ")[0])
+        return self._message(user_id, text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': length}])
+
+    # A caption with url entities like Telegram sends, optionally on a photo
+    def links(self, user_id, links, photo=False):
+        text = "🎬 New video 👇\n"
+        entities = []
+        for link in links:
+            entities.append({'type': 'url', 'offset': len(text.encode("utf-16-le")) // 2, 'length': len(link)})
+            text += link + "\n"
+        text += "Join @channel for more"
+        if not photo:
+            return self._message(user_id, text=text, entities=entities)
+        size = {'file_id': f"photo{user_id}", 'file_unique_id': f"u{user_id}", 'width': 1280, 'height': 720}
+        return self._message(user_id, caption=text, caption_entities=entities, photo=[size])
+
+
+def random_key(rng):
+    return "1" + "".join(rng.choices(string.ascii_letters + string.digits, k=22))
+
+
+# --- Measurement --------------------------------------------------------------------
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+class Upstreams:
+    def __init__(self, telegram, shortener, mongo_client):
+        self.telegram = telegram
+        self.shortener = shortener
+        self.mongo_client = mongo_client
+
+    def snapshot(self):
+        counts = Counter({f"telegram.{method}": count for method, count in self.telegram.calls.items()})
+        counts.update({f"bisgram.{outcome}": count for outcome, count in self.shortener.calls.items()})
+        counts.update({f"mongo.{operation}": count for operation, count in self.mongo_client.op_counts().items()})
+        return counts
+
+
+# Process updates with at most `concurrency` in flight, returning per-update latencies and the wall time
+async def drive(application, updates, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def process(update):
+        async with semaphore:
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(process(update) for update in updates))
+    return latencies, time.perf_counter() - started
+
+
+def report(name, latencies, seconds, errors, calls):
+    ordered = sorted(latencies)
+    p50, p95, p99 = (percentile(ordered, fraction) * 1000 for fraction in (0.5, 0.95, 0.99))
+    rate = len(latencies) / seconds if seconds else 0.0
+    print(f"{name:<12}{len(latencies):>8}{seconds:>9.2f}{rate:>10.1f}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}{errors:>8}")
+    if calls:
+        print(" " * 12 + ", ".join(f"{call}={count}" for call, count in sorted(calls.items())))
+
+
+# --- Scenarios ----------------------------------------------------------------------
+
+async def run(args, bot, mongo_client, telegram, telegram_url, shortener):
+    rng = random.Random(args.seed)
+    user_ids = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    link_pool = [f"https://teraboxapp.com/s/{random_key(rng)}" for _ in range(args.distinct_links)]
+
+    application = (
+        Application.builder().token(TOKEN).base_url(f"{telegram_url}/bot")
+        .request(bot.TracedRequest(connection_pool_size=bot.TELEGRAM_CONNECTION_POOL_SIZE))
+        .rate_limiter(bot.send_scheduler).build()
+    )
+    bot.register_handlers(application)
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors['total'] += 1
+        if args.verbose:
+            logging.getLogger(__name__).error("Handler error", exc_info=context.error)
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    bot.known_users.start()
+    bot.shorten_queue.start(application.bot)
+    updates = Updates(application.bot)
+    upstreams = Upstreams(telegram, shortener, mongo_client)
+    flooded = []
+    batched = []
+
+    async def start():
+        return [updates.command(user_id, "/start") for user_id in user_ids]
+
+    async def connect():
+        return [
+            updates.command(user_id, f"/connect {'invalid' if rng.random() < args.invalid_keys else 'key'}{user_id}")
+            for user_id in user_ids
+        ]
+
+    async def message():
+        return [
+            updates.links(
+                rng.choice(user_ids),
+                rng.sample(link_pool, rng.randint(1, min(args.links, len(link_pool)))),
+                photo=rng.random() < 0.3
+            )
+            for _ in range(args.messages)
+        ]
+
+    # Some users blocked the bot since they last wrote to it
+    async def broadcast():
+        telegram.blocked.update(str(user_id) for user_id in rng.sample(user_ids, int(len(user_ids) * args.blocked)))
+        return [updates.command(ADMIN_ID, "/broadcast Benchmark broadcast")]
+
+    # A busy group got a flood wait; replies to everyone else must not wait for it
+    async def flood():
+        telegram.blocked.clear()
+        telegram.flooded[str(FLOODED_GROUP_ID)] = args.flood_wait
+        flooded.append(asyncio.create_task(application.bot.send_message(FLOODED_GROUP_ID, "Benchmark group post")))
+        while str(FLOODED_GROUP_ID) in telegram.flooded:
+            await asyncio.sleep(0.01)
+        return [updates.command(user_id, "/start") for user_id in user_ids]
+
+    # Link messages with links not shortened yet, through a backend with a multi-url API
+    async def batch():
+        batched.append(bot.shortener.backend)
+        bot.shortener.backend = fake_batch_backend(args.shortener_batch)
+        fresh = [f"https://teraboxapp.com/s/{random_key(rng)}" for _ in range(args.distinct_links)]
+        batched.append((bot.url_cache.upstream_calls, shortener.calls.copy()))
+        return [
+            updates.links(
+                rng.choice(user_ids),
+                rng.sample(fresh, rng.randint(1, min(args.links, len(fresh)))),
+                photo=rng.random() < 0.3
+            )
+            for _ in range(args.messages)
+        ]
+
+    # Work left running in the background once the handlers returned
+    async def settle(name):
+        if name == "start":
+            await bot.known_users.flush()
+        if name == "message":
+            await bot.shorten_queue.join()
+        if name == "broadcast":
+            await asyncio.gather(*list(bot.broadcaster._tasks.values()))
+        if name == "flood":
+            await asyncio.gather(*flooded)
+        if name == "batch":
+            await bot.shorten_queue.join()
+            bot.shortener.backend = batched[0]
+
+    # Replies to other chats must not have waited for the group's flood wait
+    def check(name, latencies):
+        if name == "flood" and latencies:
+            slowest = max(latencies)
+            verdict = "ok" if slowest < args.flood_wait else "FAILED, replies waited for the group's flood wait"
+            print(" " * 12 + f"slowest reply {slowest * 1000:.0f} ms during a {args.flood_wait} s group flood wait: {verdict}")
+        # Every upstream call the cache counted was one request to the shortener, most of them batches
+        if name == "batch":
+            upstream_before, calls_before = batched[1]
+            calls = shortener.calls - calls_before
+            requests = calls['batch_calls'] + calls['shortened'] + calls['rejected'] + calls['error']
+            counted = bot.url_cache.upstream_calls - upstream_before
+            verdict = "ok" if calls['batch_calls'] and counted == requests else "FAILED"
+            print(" " * 12 + f"{calls['batch_shortened']} urls in {calls['batch_calls']} batch calls, "
+                  f"{counted} upstream calls counted for {requests} requests: {verdict}")
+
+    scenarios = {'start': start, 'connect': connect, 'message': message, 'broadcast': broadcast, 'flood': flood,
+                 'batch': batch}
+    print(f"{args.users} users, {args.messages} messages, concurrency {args.concurrency}, "
+          f"bisgram {args.shortener_latency * 1000:.0f} ms / {args.shortener_error_rate:.0%} errors, "
+          f"telegram {args.telegram_latency * 1000:.0f} ms")
+    print(f"{'scenario':<12}{'updates':>8}{'seconds':>9}{'upd/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    try:
+        for name in args.scenarios.split(","):
+            name = name.strip()
+            batch = await scenarios[name]()
+            before, errors_before = upstreams.snapshot(), errors['total']
+            started = time.perf_counter()
+            latencies, _ = await drive(application, batch, args.concurrency)
+            await settle(name)
+            seconds = time.perf_counter() - started
+            report(name, latencies, seconds, errors['total'] - errors_before, upstreams.snapshot() - before)
+            check(name, latencies)
+    finally:
+        await bot.stop_services(application)
+        await application.shutdown()
+        await bot.shutdown(application)
+
+    stats = bot.url_cache.stats()
+    print(f"short url cache: hit rate {stats['hit_rate']:.1%}, upstream calls {stats['upstream_calls']}, "
+          f"coalesced {stats['coalesced']}")
+
+
+def main():
+    args = parse_args()
+    servers = ServerThread()
+    telegram = FakeTelegram(TOKEN, latency=args.telegram_latency)
+    shortener = FakeShortener(latency=args.shortener_latency, error_rate=args.shortener_error_rate)
+    telegram_url = servers.serve(telegram.http_server)
+    shortener_url = servers.serve(shortener.http_server)
+
+    # Settings are read when bot and its modules are imported
+    os.environ.update(TELEGRAM_TOKEN=TOKEN, ADMIN_ID=str(ADMIN_ID), SHORTENER_API_URL=f"{shortener_url}/api")
+    for name in ("SEND_RATE", "SEND_CHAT_RATE", "SEND_CHAT_BURST"):
+        os.environ.setdefault(name, "100000")
+    mongo_client = install_memory_mongo()
+    import bot
+    import migrations
+    logging.getLogger().setLevel(logging.WARNING if args.verbose else logging.CRITICAL)
+    migrations.migrate()
+
+    try:
+        asyncio.run(run(args, bot, mongo_client, telegram, telegram_url, shortener))
+    finally:
+        servers.close(telegram.http_server, shortener.http_server)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Micro-benchmark for link extraction over a corpus of real-world captions.
+
+Compares the original inline extraction from handle_message with links.py,
+both on plain text (regex fallback) and on messages carrying Telegram url
+entities. Run with: python benchmarks/bench_links.py [iterations]
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from telegram import Message, MessageEntity  # noqa: E402
+
+from links import LINK_RE, extract_links, find_links, dedupe_links, terabox_key  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "captions.txt")
+
+
+def load_captions():
+    with open(CORPUS, encoding="utf-8") as f:
+        return [caption.strip() for caption in f.read().split("\n%%\n") if caption.strip()]
+
+
+# Build a message whose url entities are set like Telegram would (UTF-16 offsets)
+def message_with_entities(caption):
+    entities = []
+    for match in LINK_RE.finditer(caption):
+        link = match.group().rstrip(".,;:!?)")
+        offset = len(caption[:match.start()].encode("utf-16-le")) // 2
+        length = len(link.encode("utf-16-le")) // 2
+        entities.append(MessageEntity(MessageEntity.URL, offset, length))
+    return Message(message_id=1, date=None, chat=None, caption=caption, caption_entities=entities)
+
+
+# The extraction handle_message did before links.py
+def legacy_extract(text):
+    keys = []
+    for link in re.findall(r"(https?://[^\s]+)", text):
+        if "/s/" in link:
+            link1 = re.sub(r'^.*\/s/', '/s/', link)
+            keys.append(link1.replace("/s/", ""))
+    return keys
+
+
+def regex_extract(text):
+    return [key for key in map(terabox_key, dedupe_links(find_links(text))) if key]
+
+
+def entity_extract(message):
+    return [key for key in map(terabox_key, extract_links(message)) if key]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    captions = load_captions()
+    messages = [message_with_entities(caption) for caption in captions]
+
+    cases = [
+        ("legacy findall + re.sub", lambda: [legacy_extract(c) for c in captions],
+         sum(len(legacy_extract(c)) for c in captions)),
+        ("links.py regex fallback", lambda: [regex_extract(c) for c in captions],
+         sum(len(regex_extract(c)) for c in captions)),
+        ("links.py entities", lambda: [entity_extract(m) for m in messages],
+         sum(len(entity_extract(m)) for m in messages)),
+    ]
+
+    print(f"{len(captions)} captions, {iterations} iterations")
+    print(f"{'case':<28}{'us/caption':>12}{'keys':>8}")
+    for name, run, keys in cases:
+        seconds = timeit.timeit(run, number=iterations)
+        print(f"{name:<28}{seconds / iterations / len(captions) * 1e6:>12.2f}{keys:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+"""Offline stand-ins for the bot's dependencies, used by the load-test harness.
+
+- MemoryClient: an in-memory MongoDB with the subset of the pymongo collection
+  API the bot uses, plugged into db.AsyncMongo so the real executor path runs.
+- FakeTelegram: a local Bot API server answering the methods the bot calls.
+- FakeShortener: a local bisgram /api endpoint with configurable latency and
+  error rate, plus a multi-url /api/batch endpoint for fake_batch_backend().
+
+The servers run on their own event loop in a background thread, so their work
+does not show up in the bot's latency.
+"""
+import asyncio
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertOneResult, UpdateResult
+
+from server import HttpServer, Response
+
+
+# --- In-memory MongoDB ---------------------------------------------------------
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            for op, operand in condition.items():
+                if op == '$exists':
+                    if (field in doc) != bool(operand):
+                        return False
+                elif op == '$in':
+                    if value not in operand:
+                        return False
+                elif op == '$nin':
+                    if value in operand:
+                        return False
+                elif op == '$ne':
+                    if value == operand:
+                        return False
+                elif value is None:
+                    return False
+                elif op == '$gt' and not value > operand:
+                    return False
+                elif op == '$gte' and not value >= operand:
+                    return False
+                elif op == '$lt' and not value < operand:
+                    return False
+                elif op == '$lte' and not value <= operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return copy.deepcopy(doc)
+    included = [field for field, flag in projection.items() if flag and field != '_id']
+    if not included:
+        return {k: copy.deepcopy(v) for k, v in doc.items() if projection.get(k, 1)}
+    result = {field: copy.deepcopy(doc[field]) for field in included if field in doc}
+    if projection.get('_id', 1) and '_id' in doc:
+        result['_id'] = doc['_id']
+    return result
+
+
+def _apply_update(doc, update, inserting):
+    for field, value in update.get('$set', {}).items():
+        doc[field] = copy.deepcopy(value)
+    if inserting:
+        for field, value in update.get('$setOnInsert', {}).items():
+            doc[field] = copy.deepcopy(value)
+    for field, amount in update.get('$inc', {}).items():
+        doc[field] = doc.get(field, 0) + amount
+    for field in update.get('$unset', {}):
+        doc.pop(field, None)
+
+
+class MemoryCursor:
+    def __init__(self, docs):
+        self._docs = iter(docs)
+
+    def batch_size(self, size):
+        return self
+
+    def close(self):
+        self._docs = iter(())
+
+    def __iter__(self):
+        return self._docs
+
+
+# A collection kept in a dict by _id. Unique indexes are enforced and every
+# index on plain equality fields is used for lookups, so queries by user_id
+# stay O(1) however many users the benchmark creates. Thread-safe, as it is
+# called from the AsyncMongo executor.
+class MemoryCollection:
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}
+        self.indexes = {}
+        self.ops = Counter()
+        self._lock = threading.RLock()
+
+    def create_index(self, keys, unique=False, **kwargs):
+        fields = tuple(field for field, _ in keys)
+        with self._lock:
+            if fields not in self.indexes:
+                entries = {}
+                for doc in self.docs.values():
+                    entries.setdefault(self._index_key(fields, doc), set()).add(doc['_id'])
+                self.indexes[fields] = {'unique': unique, 'entries': entries}
+            self.indexes[fields]['unique'] |= unique
+        return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+    @staticmethod
+    def _index_key(fields, doc):
+        return tuple(doc.get(field) for field in fields)
+
+    def _index(self, doc):
+        for fields, index in self.indexes.items():
+            index['entries'].setdefault(self._index_key(fields, doc), set()).add(doc['_id'])
+
+    def _unindex(self, doc):
+        for fields, index in self.indexes.items():
+            ids = index['entries'].get(self._index_key(fields, doc))
+            if ids is not None:
+                ids.discard(doc['_id'])
+
+    def _check_unique(self, doc):
+        if doc['_id'] in self.docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_")
+        for fields, index in self.indexes.items():
+            if index['unique'] and index['entries'].get(self._index_key(fields, doc)):
+                raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: {fields}")
+
+    # Candidate documents for a query, narrowed by an index on its equality fields
+    def _candidates(self, query):
+        if '_id' in query and not isinstance(query['_id'], dict):
+            doc = self.docs.get(query['_id'])
+            return [doc] if doc is not None else []
+        equal = {field for field, value in query.items() if not isinstance(value, dict) and not field.startswith('$')}
+        for fields, index in self.indexes.items():
+            if set(fields) <= equal:
+                ids = index['entries'].get(tuple(query[field] for field in fields), ())
+                return [self.docs[_id] for _id in ids]
+        return list(self.docs.values())
+
+    def _find(self, query, sort=None):
+        docs = [doc for doc in self._candidates(query or {}) if _matches(doc, query or {})]
+        for field, direction in reversed(sort or []):
+            docs.sort(key=lambda doc: (doc.get(field) is not None, doc.get(field)), reverse=direction == -1)
+        return docs
+
+    def find_one(self, query=None, projection=None, **kwargs):
+        with self._lock:
+            self.ops['find_one'] += 1
+            docs = self._find(query, kwargs.get('sort'))
+            return _project(docs[0], projection) if docs else None
+
+    def find(self, query=None, projection=None, sort=None, **kwargs):
+        with self._lock:
+            self.ops['find'] += 1
+            docs = [_project(doc, projection) for doc in self._find(query, sort)]
+        return MemoryCursor(docs)
+
+    def count_documents(self, query, **kwargs):
+        with self._lock:
+            self.ops['count_documents'] += 1
+            return len(self._find(query))
+
+    def insert_one(self, document, **kwargs):
+        with self._lock:
+            self.ops['insert_one'] += 1
+            document.setdefault('_id', ObjectId())
+            doc = copy.deepcopy(document)
+            self._check_unique(doc)
+            self.docs[doc['_id']] = doc
+            self._index(doc)
+            return InsertOneResult(doc['_id'], True)
+
+    def _update(self, query, update, upsert):
+        docs = self._find(query)
+        if docs:
+            doc = docs[0]
+            self._unindex(doc)
+            _apply_update(doc, update, inserting=False)
+            self._index(doc)
+            return {'n': 1, 'nModified': 1}
+        if not upsert:
+            return {'n': 0, 'nModified': 0}
+        doc = {field: copy.deepcopy(value) for field, value in query.items()
+               if not field.startswith('$') and not isinstance(value, dict)}
+        doc.setdefault('_id', ObjectId())
+        _apply_update(doc, update, inserting=True)
+        self._check_unique(doc)
+        self.docs[doc['_id']] = doc
+        self._index(doc)
+        return {'n': 1, 'nModified': 0, 'upserted': doc['_id']}
+
+    def update_one(self, query, update, upsert=False, **kwargs):
+        with self._lock:
+            self.ops['update_one'] += 1
+            return UpdateResult(self._update(query, update, upsert), True)
+
+    def update_many(self, query, update, upsert=False, **kwargs):
+        with self._lock:
+            self.ops['update_many'] += 1
+            docs = self._find(query)
+            for doc in docs:
+                self._unindex(doc)
+                _apply_update(doc, update, inserting=False)
+                self._index(doc)
+            if docs or not upsert:
+                return UpdateResult({'n': len(docs), 'nModified': len(docs)}, True)
+            return UpdateResult(self._update(query, update, upsert), True)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        with self._lock:
+            self.ops['bulk_write'] += 1
+            result = {'nMatched': 0, 'nModified': 0, 'nUpserted': 0, 'nInserted': 0, 'nRemoved': 0, 'upserted': []}
+            for index, request in enumerate(requests):
+                raw = self._update(request._filter, request._doc, request._upsert)
+                if 'upserted' in raw:
+                    result['nUpserted'] += 1
+                    result['upserted'].append({'index': index, '_id': raw['upserted']})
+                else:
+                    result['nMatched'] += raw['n']
+                    result['nModified'] += raw['nModified']
+            return BulkWriteResult(result, True)
+
+    def delete_one(self, query, **kwargs):
+        with self._lock:
+            self.ops['delete_one'] += 1
+            docs = self._find(query)
+            if not docs:
+                return DeleteResult({'n': 0}, True)
+            self._unindex(docs[0])
+            del self.docs[docs[0]['_id']]
+            return DeleteResult({'n': 1}, True)
+
+    def delete_many(self, query, **kwargs):
+        with self._lock:
+            self.ops['delete_many'] += 1
+            docs = self._find(query)
+            for doc in docs:
+                self._unindex(doc)
+                del self.docs[doc['_id']]
+            return DeleteResult({'n': len(docs)}, True)
+
+
+class MemoryDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name)
+        return self.collections[name]
+
+    def command(self, name, *args, **kwargs):
+        return {'ok': 1.0}
+
+
+# Drop-in for pymongo.MongoClient as far as db.AsyncMongo is concerned
+class MemoryClient:
+    def __init__(self):
+        self.databases = {}
+        self.admin = MemoryDatabase()
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase()
+        return self.databases[name]
+
+    def close(self):
+        pass
+
+    # Operation counts per collection, e.g. {'users.bulk_write': 3}
+    def op_counts(self):
+        counts = Counter()
+        for database in self.databases.values():
+            for collection in database.collections.values():
+                for operation, count in collection.ops.items():
+                    counts[f"{collection.name}.{operation}"] += count
+        return counts
+
+
+# Point the db module at an in-memory MongoDB. Must run before bot is imported,
+# since bot binds the collections at import time.
+def install_memory_mongo():
+    import db
+
+    client = MemoryClient()
+    db.mongo = db.AsyncMongo(lambda: client)
+    db.migration_mongo = db.AsyncMongo(lambda: client, workers=1)
+    for attribute, value in list(vars(db).items()):
+        if isinstance(value, db.AsyncCollection):
+            setattr(db, attribute, db.mongo.collection(value.database, value.name))
+    return client
+
+
+# --- Fake HTTP servers ------------------------------------------------------------
+
+# Runs HttpServers on a private event loop in a daemon thread
+class ServerThread:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="fake-servers", daemon=True)
+        self._thread.start()
+
+    # Start the server on a free local port and return its base url
+    def serve(self, http_server):
+        asyncio.run_coroutine_threadsafe(http_server.start("127.0.0.1", 0), self.loop).result()
+        port = http_server._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}"
+
+    def close(self, *http_servers):
+        for http_server in http_servers:
+            asyncio.run_coroutine_threadsafe(http_server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+def _sleep(latency, jitter):
+    return asyncio.sleep(max(0.0, random.gauss(latency, latency * jitter))) if latency else asyncio.sleep(0)
+
+
+# Local Telegram Bot API: answers every method the bot uses with a plausible
+# result and counts calls per method. Chats in `blocked` answer 403 like a user
+# who blocked the bot, chats in `flooded` answer their next send with a 429 flood wait.
+class FakeTelegram:
+    METHODS = ('getMe', 'sendMessage', 'sendPhoto', 'sendVideo', 'sendDocument', 'copyMessage',
+               'editMessageText', 'sendChatAction', 'getChat', 'getChatMember', 'getFile', 'setWebhook', 'deleteWebhook')
+
+    def __init__(self, token, latency=0.0, jitter=0.2, blocked=()):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.blocked = set(blocked)
+        # chat_id -> retry_after of a flood wait answered to the next send there
+        self.flooded = {}
+        self.calls = Counter()
+        self.http_server = HttpServer()
+        self._message_ids = itertools.count(1)
+        for method in self.METHODS:
+            self.http_server.route("POST", f"/bot{token}/{method}", self._handler(method))
+
+    @staticmethod
+    def _params(request):
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            return {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+        return {}
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        if method == 'getChatMember':
+            rights = ('is_anonymous', 'can_manage_chat', 'can_delete_messages', 'can_manage_video_chats',
+                      'can_restrict_members', 'can_promote_members', 'can_change_info', 'can_invite_users',
+                      'can_post_messages')
+            return {'status': 'administrator', 'user': self._result('getMe', params), 'can_be_edited': False,
+                    **{right: right != 'is_anonymous' for right in rights}}
+        if method == 'getChat':
+            return {'id': int(params.get('chat_id', 0)), 'type': 'channel', 'title': 'Bench channel'}
+        if method.startswith('send') and method != 'sendChatAction' or method == 'editMessageText':
+            message = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+            }
+            if 'text' in params:
+                message['text'] = params['text']
+            return message
+        return True
+
+    def _handler(self, method):
+        async def handle(request):
+            self.calls[method] += 1
+            await _sleep(self.latency, self.jitter)
+            params = self._params(request)
+            if params.get('chat_id') in self.blocked:
+                body = {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+                return Response(403, json.dumps(body), "application/json")
+            retry_after = self.flooded.pop(params.get('chat_id'), None)
+            if retry_after is not None:
+                body = {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                        'parameters': {'retry_after': retry_after}}
+                return Response(429, json.dumps(body), "application/json")
+            return Response(200, json.dumps({'ok': True, 'result': self._result(method, params)}), "application/json")
+
+        return handle
+
+
+# Local bisgram /api. Answers after `latency` seconds (gaussian jitter), fails
+# with HTTP 500 at `error_rate`, and rejects api keys starting with "invalid".
+class FakeShortener:
+    def __init__(self, latency=0.05, jitter=0.2, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.http_server = HttpServer()
+        self.http_server.route("GET", "/api", self._shorten)
+        self.http_server.route("POST", "/api/batch", self._shorten_batch)
+
+    async def _shorten(self, request):
+        await _sleep(self.latency, self.jitter)
+        if random.random() < self.error_rate:
+            self.calls['error'] += 1
+            return Response(500, "Internal Server Error")
+        api_key = request.query.get('api', [''])[0]
+        long_url = request.query.get('url', [''])[0]
+        if not api_key or api_key.startswith("invalid"):
+            self.calls['rejected'] += 1
+            body = {'status': 'error', 'message': ['Invalid API token.']}
+        else:
+            self.calls['shortened'] += 1
+            body = {'status': 'success', 'shortenedUrl': self._short_url(api_key, long_url)}
+        return Response(200, json.dumps(body), "application/json")
+
+    # POST {"api": KEY, "urls": [...]}, answers {"status": "success", "shortenedUrls": [...]} in order
+    async def _shorten_batch(self, request):
+        await _sleep(self.latency, self.jitter)
+        if random.random() < self.error_rate:
+            self.calls['error'] += 1
+            return Response(500, "Internal Server Error")
+        payload = json.loads(request.body or b"{}")
+        api_key, long_urls = payload.get('api', ''), payload.get('urls', [])
+        self.calls['batch_calls'] += 1
+        if not api_key or api_key.startswith("invalid"):
+            self.calls['batch_rejected'] += len(long_urls)
+            body = {'status': 'error', 'message': ['Invalid API token.']}
+        else:
+            self.calls['batch_shortened'] += len(long_urls)
+            body = {'status': 'success', 'shortenedUrls': [self._short_url(api_key, url) for url in long_urls]}
+        return Response(200, json.dumps(body), "application/json")
+
+    @staticmethod
+    def _short_url(api_key, long_url):
+        return f"https://bisgram.com/{abs(hash((api_key, long_url))):x}"
+
+
+# bisgram with the multi-url /api/batch endpoint of FakeShortener, taking up to
+# max_batch urls per call. shortener is imported here, so importing this module
+# does not read the shortener settings before the harness sets them.
+def fake_batch_backend(max_batch):
+    from shortener import BatchShortenerBackend, BisgramBackend
+
+    class FakeBatchBackend(BisgramBackend, BatchShortenerBackend):
+        name = "fake_batch"
+
+        def batch_request(self, endpoint, api_key, long_urls):
+            return "POST", endpoint + "/batch", {"json": {"api": api_key, "urls": long_urls}}
+
+        def parse_batch(self, data, long_urls):
+            if isinstance(data, dict) and data.get("status") == "success":
+                return data.get("shortenedUrls") or []
+            return [None] * len(long_urls)
+
+    backend = FakeBatchBackend()
+    backend.max_batch = max_batch
+    return backend
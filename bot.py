@@ -1,95 +1,181 @@
+import functools
+import io
 import logging
 import os
-import socket
-import re
-import threading
-import requests
 from telegram import Update
+from telegram.constants import ChatAction, ChatType
+from telegram.error import TelegramError
 from telegram.ext import Application, MessageHandler, CommandHandler, CallbackContext, filters
-from pymongo import MongoClient
 from dotenv import load_dotenv
 
 
-# Load environment variables from .env file
+# Load environment variables from .env file, before the modules below read their settings
 load_dotenv()
 
-# MongoDB setup
-client = MongoClient(os.getenv("MONGO_URI"))
-db = client['telegram_bot']
-user_collection = db['users']
-api_collection = db['api_id']
-user_channels_collection = db['user_channels']  # New collection for storing user channels
+# Set up logging
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
 
+from db import (mongo, user_collection, api_collection, user_channels_collection, short_url_collection,
+                broadcast_jobs_collection, update_claims_collection, chat_status_collection, stats_collection,
+                shorten_jobs_collection)
+from shortener import ShortenerClient, ShortenerError
+from cache import ShortUrlCache, ApiKeyCache
+from broadcast import BroadcastEngine, ChannelFanout
+from server import HttpServer, health, readiness_handler, metrics_endpoint, webhook_handler, run_webhook, run_polling
+from metrics import instrumented
+from tracing import span, SampledProfiler, TracedRequest, PROFILE_SAMPLE_RATE
+from links import extract_links, terabox_key
+from admission import AdmissionController
+from bulk import BULK_MAX_FILE_SIZE, iter_file_links, shorten_links_to_csv
+from users import KnownUsers
+from cluster import WORKER_COUNT, WORKER_INDEX, INTERNAL_UPDATES_PATH, UpdateClaims, ClusterRouter
+from migrations import check_schema
+from validation import ApiKeyValidator
+from chats import DeadChats, DEAD_REASONS, failure_reason
+from stats import StatsCounters
+from scheduler import SendScheduler, SEND_RATE, BULK
+from jobs import ShortenQueue, RetryJob
+from channels import ChannelRegistry
+
+# Shortened url cache, the Mongo tier can be turned off with SHORT_URL_CACHE_MONGO=0
+url_cache = ShortUrlCache(short_url_collection if os.getenv("SHORT_URL_CACHE_MONGO", "1") == "1" else None)
+
+# Counters behind /stats, written with $inc in batches; the cache hit rate comes from url_cache
+counters = StatsCounters(stats_collection)
+counters.track(lambda: {'cache_hits': url_cache.hits + url_cache.persistent_hits, 'cache_misses': url_cache.misses})
+
+# Cached user_id -> api_id lookups, kept in sync by add_user_api and /disconnect
+api_keys = ApiKeyCache(api_collection)
+
+# Chats that blocked the bot or no longer exist, skipped by broadcasts and channel forwards
+dead_chats = DeadChats(chat_status_collection)
+
+# Known-user filter with write-behind batching for add_user
+known_users = KnownUsers(user_collection, stats=counters)
+
+# Every Bot API send goes through this scheduler: global and per-chat limits, with
+# replies ahead of bulk sends. Telegram's limits are per bot, so workers split the global rate.
+send_scheduler = SendScheduler(rate=SEND_RATE / WORKER_COUNT)
+
+# Background broadcast jobs, /broadcast goes to all users and /broadcast_api to connected users;
+# chunks are sized to this worker's share of the bulk rate
+broadcaster = BroadcastEngine(broadcast_jobs_collection, {'users': user_collection, 'api': api_collection},
+                              chats=dead_chats, stats=counters, rate=send_scheduler.bulk_bucket.rate)
+
+# Per-user token buckets and a bounded queue in front of handle_message
+admission = AdmissionController()
+
+# Exactly-once claims for webhook updates delivered to several workers
+update_claims = UpdateClaims(update_claims_collection)
+
+# Registered channels with the bot's cached permission state, revalidated in the background
+channel_registry = ChannelRegistry(user_channels_collection, chats=dead_chats)
+
+# Copies admin messages to every writable registered channel in the bulk send lane
+channel_fanout = ChannelFanout(channel_registry, chats=dead_chats, stats=counters)
 
-# MongoDB Indexes
-user_collection.create_index([('user_id', 1)], unique=True)
-api_collection.create_index([('user_id', 1)], unique=True)
-user_channels_collection.create_index([('user_id', 1)], unique=True)  # Index for user channels
 
 # Telegram bot token from environment variables
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 
-# Set up logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Update delivery: BOT_MODE=webhook receives updates on the HTTP port instead of polling
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Public base url, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# How many updates the Application handles at once, message handling is further limited by admission control
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "256"))
+
+# Shared non-blocking client for the shortener backend (bisgram by default) and its endpoints
+shortener = ShortenerClient()
+
+# Runtime profiler switched on and off by the admin with /profile
+profiler = SampledProfiler()
+
+# Connections to the Bot API shared by all handlers, every request is traced as a span of its update
+TELEGRAM_CONNECTION_POOL_SIZE = int(os.getenv("TELEGRAM_CONNECTION_POOL_SIZE", "256"))
 
 # Helper function to check if user is admin
 def is_admin(user_id):
     return str(user_id) == os.getenv("ADMIN_ID")
 
-# Function to add a new user to MongoDB
-def add_user(user_id, username):
-    try:
-        user_collection.update_one(
-            {'user_id': user_id},
-            {'$set': {'user_id': user_id, 'username': username}},
-            upsert=True
-        )
-    except Exception as e:
-        logger.error(f"Error adding user: {e}")
-def add_user_channel(user_id, channel_id):
+# Function to add a new user to MongoDB, repeat users are skipped and new ones written in batches
+async def add_user(user_id, username):
+    await known_users.add(user_id, username)
+
+async def add_user_channel(user_id, channel_id):
     try:
-        user_channels_collection.update_one(
+        result = await user_channels_collection.update_one(
             {'user_id': user_id},
             {'$set': {'user_id': user_id, 'channel_id': channel_id}},
             upsert=True
         )
+        if result.upserted_id is not None:
+            counters.inc(channels=1)
     except Exception as e:
         logger.error(f"Error adding user channel: {e}")
 
 # Function to add user and API to MongoDB
-def add_user_api(user_id, api_id):
+async def add_user_api(user_id, api_id):
     try:
-        api_collection.update_one(
+        result = await api_collection.update_one(
             {'user_id': user_id},
             {'$set': {'user_id': user_id, 'api_id': api_id}},
             upsert=True
         )
+        if result.upserted_id is not None:
+            counters.inc(connected_keys=1)
+        api_keys.set(user_id, api_id)
     except Exception as e:
         logger.error(f"Error adding user API: {e}")
 
+# Reply used when bisgram is failing or the shortener circuit is open
+SHORTENER_DOWN_TEXT = "⚠️ The link shortener is not responding right now. Please try again in a few minutes."
+
 # Validate API ID
 async def validate_api_id(api_id):
     try:
-        test_url = "https://example.com"  # Replace with a valid URL for testing
-        api_url = f"https://bisgram.com/api?api={api_id}&url={test_url}"
-        response = requests.get(api_url)
-        if response.json().get("status") == "success":
-            return True
-        return False
+        return await shortener.shorten(api_id, shortener.test_url) is not None
+    except ShortenerError:
+        # The key could not be checked, let the caller tell the user to retry later
+        raise
     except Exception as error:
         logger.error(f"Error validating API key: {error}")
         return False
 
+# Cached, deduplicated validate_api_id for /connect, keys that cannot be checked are retried in the background
+api_key_validator = ApiKeyValidator(validate_api_id)
+
+# Reply to /connect when the key could not be checked and was queued for a later check
+KEY_CHECK_DEFERRED_TEXT = (
+    "⏳ The link shortener is not responding right now, so your API key could not be checked yet.\n\n"
+    "It will be checked automatically as soon as the shortener is back, and you will get a message."
+)
+
+# Finish a /connect whose key was checked in the background
+async def on_key_validated(bot, user_id, chat_id, api_id, valid):
+    if valid:
+        await add_user_api(user_id, api_id)
+        await bot.send_message(chat_id=chat_id, text="✅ API key connected successfully! Send Terabox link for converting")
+    else:
+        await bot.send_message(chat_id=chat_id, text="❌ Invalid API key. Please try again.\n\nHow to connect /help")
+
 # /start command handler
 async def start(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
     username = update.message.from_user.username
-    add_user(user_id, username)
-    user = api_collection.find_one({"user_id": user_id})
-
-    if user:
+    # A user who blocked the bot or was purged is back, write the user again
+    with span("add_user"):
+        if await dead_chats.revive(user_id):
+            known_users.forget(user_id)
+        await add_user(user_id, username)
+    with span("lookup_key"):
+        api_id = await api_keys.get(user_id)
+
+    if api_id:
         await update.message.reply_text(f"📮 Hello {update.message.from_user.first_name}, \nYou are now successfully connected to our Terabis platform.\n\nSend Terabox link for converting")
     else:
         await update.message.reply_text(
@@ -124,10 +210,8 @@ async def broadcast(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("Please provide a message to broadcast.\n like this /broadcast message")
             return
 
-        users = user_collection.find()
-        for user in users:
-            await context.bot.send_message(chat_id=user['user_id'], text=message)
-        await update.message.reply_text("Message broadcasted!")
+        await broadcaster.start(context.bot, 'users', message, update.message.chat_id)
+        await update.message.reply_text("📣 Broadcast started in the background. You will get a report when it finishes.")
     else:
         await update.message.reply_text("You are not authorized to broadcast.")
 
@@ -139,10 +223,8 @@ async def broadcast_api(update: Update, context: CallbackContext) -> None:
             await update.message.reply_text("Please provide a message to broadcast.\n like this /broadcast_api message")
             return
 
-        users = api_collection.find()
-        for user in users:
-            await context.bot.send_message(chat_id=user['user_id'], text=message)
-        await update.message.reply_text("Message broadcasted!")
+        await broadcaster.start(context.bot, 'api', message, update.message.chat_id)
+        await update.message.reply_text("📣 Broadcast started in the background. You will get a report when it finishes.")
     else:
         await update.message.reply_text("You are not authorized to broadcast.")
 
@@ -155,8 +237,17 @@ async def connect(update: Update, context: CallbackContext) -> None:
     api_id = message_parts[1]
     user_id = update.message.from_user.id
 
-    if await validate_api_id(api_id):
-        add_user_api(user_id, api_id)
+    try:
+        with span("validate_key"):
+            valid = await api_key_validator.validate(api_id)
+    except ShortenerError:
+        if api_key_validator.defer(user_id, update.message.chat_id, api_id):
+            return await update.message.reply_text(KEY_CHECK_DEFERRED_TEXT)
+        return await update.message.reply_text(SHORTENER_DOWN_TEXT)
+
+    api_key_validator.cancel(user_id)
+    if valid:
+        await add_user_api(user_id, api_id)
         await update.message.reply_text("✅ API key connected successfully! Send Terabox link for converting")
     else:
         await update.message.reply_text("❌ Invalid API key. Please try again.\n\nHow to connect /help")
@@ -164,14 +255,148 @@ async def connect(update: Update, context: CallbackContext) -> None:
 # Command: /disconnect
 async def disconnect(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
+    api_key_validator.cancel(user_id)
 
-    user = api_collection.find_one({"user_id": user_id})
-    if user:
-        api_collection.delete_one({"user_id": user_id})
+    api_id = await api_keys.get(user_id)
+    if api_id:
+        result = await api_collection.delete_one({"user_id": user_id})
+        counters.inc(connected_keys=-result.deleted_count)
+        api_keys.evict(user_id)
         await update.message.reply_text("✅ Your API key has been disconnected successfully.")
     else:
         await update.message.reply_text("⚠️ You have not connected an API key yet.")
 
+# Command: /cache_stats (only for admin)
+async def cache_stats(update: Update, context: CallbackContext) -> None:
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not authorized to view cache stats.")
+        return
+
+    stats = url_cache.stats()
+    key_stats = api_key_validator.stats()
+    await update.message.reply_text(
+        "📊 Shortened URL cache:\n"
+        f"- Memory hits: {stats['memory_hits']}\n"
+        f"- Mongo hits: {stats['persistent_hits']}\n"
+        f"- Misses: {stats['misses']}\n"
+        f"- Coalesced: {stats['coalesced']}\n"
+        f"- Upstream calls: {stats['upstream_calls']}\n"
+        f"- Hit rate: {stats['hit_rate']:.1%}\n"
+        f"- Cached entries: {stats['size']}\n\n"
+        "🔑 API key validation:\n"
+        f"- Cache hits: {key_stats['hits']}\n"
+        f"- Checks: {key_stats['misses']}\n"
+        f"- Coalesced: {key_stats['coalesced']}\n"
+        f"- Waiting for the shortener: {key_stats['deferred']}"
+    )
+
+# Command: /stats (only for admin), read from the counter documents instead of scanning the collections
+async def stats(update: Update, context: CallbackContext) -> None:
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not authorized to view stats.")
+        return
+
+    report = await counters.report()
+    total, days = report['total'], report['days']
+
+    def per_day(name):
+        return f"today {days[1][name]}, 7 days {days[7][name]}, 30 days {days[30][name]}"
+
+    def hit_rate(counts):
+        lookups = counts['cache_hits'] + counts['cache_misses']
+        return f"{counts['cache_hits'] / lookups:.1%}" if lookups else "n/a"
+
+    await update.message.reply_text(
+        "📊 Bot stats\n\n"
+        f"👥 Users: {total['users']} (new: {per_day('users')})\n"
+        f"🔑 Connected API keys: {total['connected_keys']} (change: {per_day('connected_keys')})\n"
+        f"📢 Channels: {total['channels']}\n\n"
+        f"🔗 Links shortened: {per_day('links_shortened')}, all time {total['links_shortened']}\n"
+        f"❌ Links failed: {per_day('links_failed')}, all time {total['links_failed']}\n"
+        f"💾 Cache hit rate: today {hit_rate(days[1])}, 7 days {hit_rate(days[7])}, all time {hit_rate(total)}\n\n"
+        f"📣 Broadcasts (30 days): delivered {days[30]['broadcast_delivered']}, failed {days[30]['broadcast_failed']}, "
+        f"blocked {days[30]['broadcast_blocked']}, skipped {days[30]['broadcast_skipped']}\n"
+        f"📤 Channel forwards (30 days): delivered {days[30]['forward_delivered']}, failed {days[30]['forward_failed']}, "
+        f"blocked {days[30]['forward_blocked']}, skipped {days[30]['forward_skipped']}"
+    )
+
+# Command: /dead_chats [purge|recheck] (only for admin)
+async def dead_chats_command(update: Update, context: CallbackContext) -> None:
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not authorized to manage unreachable chats.")
+        return
+
+    action = context.args[0].lower() if context.args else ""
+    if action == "purge":
+        users, channels = await dead_chats.purge([(user_collection, 'user_id'), (user_channels_collection, 'channel_id')])
+        counters.inc(users=-users, channels=-channels)
+        await update.message.reply_text(
+            f"🧹 Removed {users} unreachable users and {channels} channels from the broadcast audiences."
+        )
+    elif action == "recheck":
+        if not recheck_dead_chats(context.bot, update.message.chat_id):
+            await update.message.reply_text("🔄 A recheck is already running, you will get its report when it finishes.")
+            return
+        await update.message.reply_text(
+            f"🔄 Rechecking {len(dead_chats.dead)} unreachable chats in the background. You will get a report when it finishes."
+        )
+    else:
+        counts = await dead_chats.counts()
+        await update.message.reply_text(
+            f"💀 Unreachable chats: {sum(counts.values())}\n"
+            f"- Blocked the bot, deactivated or kicked: {counts['forbidden']}\n"
+            f"- Chat not found: {counts['chat_not_found']}\n\n"
+            "/dead_chats purge - Remove them from the broadcast audiences.\n"
+            "/dead_chats recheck - Check whether they are reachable again."
+        )
+
+# Probe every unreachable chat with a chat action in the bulk send lane and report to the admin.
+# The recheck runs in dead_chats, which cancels it on shutdown; returns False if one is running.
+def recheck_dead_chats(bot, admin_chat_id):
+    async def report(revived, still_dead):
+        await bot.send_message(
+            chat_id=admin_chat_id,
+            text=f"🔄 Recheck finished!\n✅ Reachable again: {revived}\n💀 Still unreachable: {still_dead}"
+        )
+
+    return dead_chats.start_recheck(
+        lambda chat_id: bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING, rate_limit_args=BULK),
+        report
+    )
+
+# Command: /profile [on [SAMPLE_RATE]|off] (only for admin), sampled profiling of this worker
+async def profile(update: Update, context: CallbackContext) -> None:
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("You are not authorized to profile the bot.")
+        return
+
+    action = context.args[0].lower() if context.args else ""
+    if action == "on":
+        if profiler.running:
+            await update.message.reply_text("🔬 Profiling is already on. Send /profile off to stop it and get the report.")
+            return
+        try:
+            sample_rate = float(context.args[1]) if len(context.args) > 1 else PROFILE_SAMPLE_RATE
+        except ValueError:
+            await update.message.reply_text("Please give the sample rate as a number, e.g. /profile on 0.1")
+            return
+        profiler.start(sample_rate)
+        await update.message.reply_text(
+            f"🔬 Profiling {profiler.sample_rate:.0%} of the time. Send /profile off to stop it and get the report."
+        )
+    elif action == "off":
+        report = await profiler.stop()
+        if report is None:
+            await update.message.reply_text("Profiling is not on. Send /profile on to start it.")
+            return
+        await update.message.reply_document(document=io.BytesIO(report.encode("utf-8")), filename="profile.txt")
+    else:
+        await update.message.reply_text(
+            f"🔬 Profiling is {'on' if profiler.running else 'off'}.\n\n"
+            "/profile on [SAMPLE_RATE] - Start sampled profiling, e.g. /profile on 0.1\n"
+            "/profile off - Stop and get the hottest functions as a file."
+        )
+
 # Command: /commands
 async def commands(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(
@@ -179,196 +404,352 @@ async def commands(update: Update, context: CallbackContext) -> None:
         "- /connect [API_KEY] - Connect your API key.\n"
         "- /disconnect - Disconnect your API key.\n"
         "- /view - View your connected API key.\n"
-        "- /help - How to connect to website."
+        "- /help - How to connect to website.\n"
+        "- Send a .txt or .csv file of links to shorten them all at once."
     )
 
 # Command: /view
 async def view(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    user = api_collection.find_one({"user_id": user_id})
-    if user and "api_id" in user:
-        await update.message.reply_text(f"✅ Your connected API key: {user['api_id']}", parse_mode='Markdown')
+    api_id = await api_keys.get(user_id)
+    if api_id:
+        await update.message.reply_text(f"✅ Your connected API key: {api_id}", parse_mode='Markdown')
     else:
         await update.message.reply_text("⚠️ No API key is connected. Use /connect to link one.")
 
-# Handle regular messages
+# Handle regular messages: the Terabox links are queued as a shorten job and the
+# result is sent by the job workers, so slow shortener calls never hold the update
 async def handle_message(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    user_data = api_collection.find_one({"user_id": user_id})
+    with span("lookup_key"):
+        api_key = await api_keys.get(user_id)
 
-    if not user_data or not user_data.get("api_id"):
+    if not api_key:
         await update.message.reply_text("⚠️ You haven't connected your API key yet. Please use /connect [API_KEY].")
         return
 
-    api_key = user_data["api_id"]
-    message_text = update.message.caption or update.message.text or ""
-
-    link_regex = r"(https?://[^\s]+)"
-    links = re.findall(link_regex, message_text)
+    with span("extract_links"):
+        links = extract_links(update.message)
 
     if not links:
         await update.message.reply_text("Please send a valid link to shorten.")
         return
 
-    shortened_links = []  # To store the formatted shortened links
-    for idx, link in enumerate(links, start=1):  # Enumerate to create Link 1, Link 2, etc.
-        if "/s/" in link:
-            link1 = re.sub(r'^.*\/s/', '/s/', link)
-            long_url = link1.replace("/s/", "https://terabis.blogspot.com/?url=")
-
-            # Shorten the link using the user's API key
-            api_url = f"https://bisgram.com/api?api={api_key}&url={long_url}"
-            response = requests.get(api_url)
-
-            if response.json().get("status") == "success":
-                shortened_url = response.json().get("shortenedUrl")
-                shortened_links.append(f"video {idx} 👇👇\n{shortened_url}")
-            # If the response status is not "success", do nothing (invalid link)
-        else:
-            # If the link is invalid, we do nothing and skip it silently
-            continue
-
-    if shortened_links:
-        # Format the response text with all the shortened links
-        response_text = "🔰 𝙁𝙐𝙇𝙇 𝙑𝙄𝘿𝙀𝙊 🎥\n\n" + "\n\n".join(shortened_links) + "\n\n♡     ❍     ⌲ \nLike React Share"
-        
-        # Send the response based on the media type
-        if update.message.photo:
-            await update.message.reply_photo(update.message.photo[-1].file_id, caption=response_text)
-        elif update.message.video:
-            await update.message.reply_video(update.message.video.file_id, caption=response_text)
-        else:
-            await update.message.reply_text(response_text)
-
-# Simple TCP Health Check Server
-def health_check_server():
+    # Keep the "video N" position of every Terabox link; links that are not Terabox are skipped silently
+    keys = [(idx, terabox_key(link)) for idx, link in enumerate(links, start=1)]
+    terabox_links = [[idx, key] for idx, key in keys if key]
+    if not terabox_links:
+        return
+
+    job = {
+        'user_id': user_id,
+        'chat_id': update.message.chat_id,
+        # Like reply_text, quote the original message in groups only
+        'reply_to': update.message.message_id if update.message.chat.type != ChatType.PRIVATE else None,
+        'api_key': api_key,
+        'links': terabox_links,
+        'photo': update.message.photo[-1].file_id if update.message.photo else None,
+        'video': update.message.video.file_id if update.message.video else None,
+    }
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind(('0.0.0.0', 8000))
-            s.listen(1)
-            logger.info("Health check server listening on port 8000...")
-            while True:
-                conn, addr = s.accept()
-                with conn:
-                    logger.info(f'Health check received from {addr}')
-                    conn.sendall(b"OK")
+        with span("enqueue"):
+            queued = await shorten_queue.enqueue(job)
     except Exception as e:
-        logger.error(f"Health check server error: {e}")
+        # Without Mongo the job cannot be stored, shorten the links while the user waits
+        logger.error(f"Error queueing shorten job: {e}")
+        await send_shortened_links(context.bot, job, final=True)
+        return
+
+    if not queued:
+        await update.message.reply_text(SHORTEN_QUEUED_TEXT)
+
+# Reply when the worker's job queue is full, the job waits in Mongo for a free worker
+SHORTEN_QUEUED_TEXT = "⏳ The bot is busy right now. Your links are queued and will be sent to you shortly."
+
+# Reply when the first attempt of a job failed because bisgram is failing, the job is retried
+SHORTEN_RETRY_TEXT = (
+    "⏳ The link shortener is not responding right now. "
+    "Your links are queued and will be sent as soon as it is back."
+)
+
+# Shorten job handler: shorten the job's links and send them with the original photo
+# or video. While bisgram is failing the job is retried, on its final attempt the
+# links that could be shortened are sent with SHORTENER_DOWN_TEXT.
+async def send_shortened_links(bot, job, final):
+    results = await url_cache.shorten_many(
+        job['api_key'], [shortener.long_url(key) for _, key in job['links']], shortener.shorten,
+        shortener.shorten_batch, shortener.max_batch
+    )
+
+    shortener_down = False
+    shortened_links = []  # To store the formatted shortened links
+    for (idx, _), shortened_url in zip(job['links'], results):
+        if isinstance(shortened_url, ShortenerError):
+            shortener_down = True
+        elif isinstance(shortened_url, Exception):
+            raise shortened_url
+        # If the shortener did not return a url, skip the link silently
+        elif shortened_url:
+            shortened_links.append(f"video {idx} 👇👇\n{shortened_url}")
+
+    if shortener_down and not final:
+        if job['attempts'] == 1:
+            await bot.send_message(chat_id=job['chat_id'], text=SHORTEN_RETRY_TEXT)
+        raise RetryJob()
+    counters.inc(links_shortened=len(shortened_links), links_failed=len(job['links']) - len(shortened_links))
+
+    reply = {'chat_id': job['chat_id'], 'reply_to_message_id': job['reply_to'], 'allow_sending_without_reply': True}
+    try:
+        if shortened_links:
+            # Format the response text with all the shortened links
+            response_text = "🔰 𝙁𝙐𝙇𝙇 𝙑𝙄𝘿𝙀𝙊 🎥\n\n" + "\n\n".join(shortened_links) + "\n\n♡     ❍     ⌲ \nLike React Share"
+
+            # Send the response based on the media type
+            if job['photo']:
+                await bot.send_photo(photo=job['photo'], caption=response_text, **reply)
+            elif job['video']:
+                await bot.send_video(video=job['video'], caption=response_text, **reply)
+            else:
+                await bot.send_message(text=response_text, **reply)
+
+        if shortener_down:
+            # Some or all links could not be shortened because bisgram is failing
+            await bot.send_message(text=SHORTENER_DOWN_TEXT, **reply)
+    except TelegramError as e:
+        # The user blocked the bot meanwhile, retrying would not help
+        reason = failure_reason(e)
+        if reason not in DEAD_REASONS:
+            raise
+        await dead_chats.record(job['chat_id'], reason)
+
+# Durable queue in front of send_shortened_links, shared by all workers through Mongo
+shorten_queue = ShortenQueue(shorten_jobs_collection, send_shortened_links)
+
+# Handle uploaded .txt/.csv files of links, shortened in bulk and returned as a csv file
+async def handle_document(update: Update, context: CallbackContext) -> None:
+    user_id = update.message.from_user.id
+    api_key = await api_keys.get(user_id)
+
+    if not api_key:
+        await update.message.reply_text("⚠️ You haven't connected your API key yet. Please use /connect [API_KEY].")
+        return
+
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE:
+        await update.message.reply_text(f"❌ The file is too large. Please send files up to {BULK_MAX_FILE_SIZE // 1024} KB.")
+        return
 
-# MongoDB Connection Test
-def test_mongo_connection():
+    status = await update.message.reply_text("⏳ Shortening the links in your file...")
+
+    async def on_progress(done):
+        try:
+            await status.edit_text(f"⏳ Shortening the links in your file... {done} done")
+        except Exception as e:
+            logger.warning(f"Error updating bulk progress: {e}")
+
+    result = io.StringIO()
     try:
-        client.admin.command('ping')
-        logger.info("MongoDB connection successful")
+        upload = io.BytesIO()
+        await (await context.bot.get_file(document.file_id)).download_to_memory(upload)
+        upload.seek(0)
+        counts = await shorten_links_to_csv(
+            iter_file_links(upload, csv_cells=(document.file_name or "").lower().endswith(".csv")),
+            lambda long_url: url_cache.get_or_shorten(api_key, long_url, shortener.shorten),
+            shortener.long_url,
+            result,
+            on_progress
+        )
     except Exception as e:
-        logger.error(f"Error connecting to MongoDB: {e}")
-      
+        # A failed download or an unreadable file, don't leave the user waiting on the status message
+        logger.error(f"Error shortening the links of file {document.file_id}: {e}")
+        await status.edit_text("❌ Could not read the links from your file. Please check it and try again.")
+        return
+
+    counters.inc(links_shortened=counts['shortened'], links_failed=counts['failed'])
+    if not any(counts.values()):
+        await status.edit_text("Please send a file with valid links to shorten.")
+        return
+
+    await status.edit_text(
+        f"✅ Done! Shortened: {counts['shortened']}, failed: {counts['failed']}, skipped: {counts['skipped']}"
+    )
+    await update.message.reply_document(
+        document=io.BytesIO(result.getvalue().encode("utf-8")),
+        filename="shortened_links.csv"
+    )
+
+# /forward command handler (only for admin), reply to a message to copy it to all registered channels
 async def forward_message_to_user(update: Update, context: CallbackContext) -> None:
     if is_admin(update.message.from_user.id):  # Only allow admin to forward messages
-        admin_message = update.message
-        users = user_channels_collection.find()  # Get all users and their registered channels
-        
-        for user in users:
-            channel_id = user.get('channel_id')
-            if admin_message.text:
-                await context.bot.send_message(chat_id=channel_id, text=admin_message.text)
-            elif admin_message.photo:
-                await context.bot.send_photo(chat_id=channel_id, photo=admin_message.photo[-1].file_id)
-            elif admin_message.video:
-                await context.bot.send_video(chat_id=channel_id, video=admin_message.video.file_id)
-        
-        await update.message.reply_text("Message has been forwarded to all registered user channels!")
+        admin_message = update.message.reply_to_message
+        if not admin_message:
+            await update.message.reply_text("Reply to the message you want to forward with /forward.")
+            return
+
+        channel_fanout.start(context.bot, admin_message.chat_id, admin_message.message_id, update.message.chat_id)
+        await update.message.reply_text("📤 Forwarding to all registered user channels in the background. You will get a report when it finishes.")
     else:
         await update.message.reply_text("You are not authorized to forward messages.")
-# /set_channel command handler (to allow user to register a channel)
 
-# Function to handle user setting their channel
+# /set_channel command handler (to allow user to register a channel), the bot's
+# permissions are checked through the channel registry instead of a test message
 async def set_channel(update: Update, context: CallbackContext) -> None:
     user_id = update.message.from_user.id
-    channel_id = update.message.text.split(" ")[1]  # Extract the channel ID
-
-
+    if not context.args:
+        await update.message.reply_text(
+            "Please provide your channel. Usage: /set_channel @channel_username or /set_channel -100CHANNEL_ID"
+        )
+        return
+    channel_id = context.args[0]  # Extract the channel ID
 
-    # Function to check if the bot is admin and can send messages in the channel
-    async def is_bot_admin_and_can_send(channel_id):
-        try:
-            # First, check if it’s a public channel
-            if channel_id.startswith('@'):
-                # For public channels, check if the bot can send a test message
-                try:
-                    test_message = "Test message for channel connection"
-                    await context.bot.send_message(chat_id=channel_id, text=test_message)
-                    return True
-                except Exception as e:
-                    logger.error(f"Error sending test message to public channel {channel_id}: {e}")
-                    return False
-            else:
-                # If it's not a public channel, assume it's a private channel and check admin status
-                chat_member = await context.bot.get_chat_member(channel_id, context.bot.id)
-                if chat_member.status in ['member', 'administrator']:
-                    try:
-                        test_message = "Test message for private channel connection"
-                        await context.bot.send_message(chat_id=channel_id, text=test_message)
-                        return True
-                    except Exception as send_error:
-                        logger.error(f"Error sending test message to {channel_id}: {send_error}")
-                        return False
-                else:
-                    logger.error(f"Bot is not an admin in private channel {channel_id}")
-                    return False
-        except Exception as e:
-            logger.error(f"Error checking bot status in {channel_id}: {e}")
-            return False
+    try:
+        writable, detail, new = await channel_registry.register(context.bot, user_id, channel_id)
+    except Exception as e:
+        # The check itself failed, e.g. Telegram or Mongo did not answer
+        await update.message.reply_text(f"❌ Failed to connect to {channel_id}. Please try again in a few minutes.")
+        logger.error(f"Error while connecting to {channel_id}: {e}")
+        return
 
-    # Check if the bot is admin and can send messages in the channel
-    if not await is_bot_admin_and_can_send(channel_id):
+    if not writable:
+        logger.info(f"Bot cannot post in {channel_id}: {detail}")
         await update.message.reply_text(f"❌ The bot cannot send messages in the channel {channel_id}. Please ensure the bot is an admin and has message-sending permissions.")
         return
 
-    try:
-        # If everything is fine, save the channel ID to MongoDB
-        user_channels_collection.update_one(
-            {'user_id': user_id},
-            {'$set': {'channel_id': channel_id}},
-            upsert=True
+    if new:
+        counters.inc(channels=1)
+    await update.message.reply_text(f"✅ Channel {channel_id} connected successfully!")
+
+
+# Routes webhook updates to the worker owning the user, set up in webhook mode
+cluster_router = None
+
+# HTTP server for liveness, readiness, metrics and (in webhook mode) Telegram updates
+http_server = HttpServer()
+http_server.route("GET", "/", health)
+http_server.route("GET", "/healthz", health)
+http_server.route("GET", "/ready", readiness_handler({'mongo': mongo.ping, 'shortener': shortener.ping}))
+http_server.route("GET", "/metrics", metrics_endpoint)
+
+
+# Start what the account and admin commands need: the HTTP server, MongoDB and a
+# check of its indexes, the known users, counters and dead chats, and retrying
+# deferred API key checks
+async def post_init_commands(application: Application) -> None:
+    await http_server.start()
+    if await mongo.connect():
+        await check_schema()
+    known_users.start()
+    counters.start()
+    dead_chats.start()
+    api_key_validator.start(functools.partial(on_key_validated, application.bot))
+
+
+# Start everything the full handler set needs: the above, the shorten job workers,
+# channel revalidation, and taking over broadcasts left without a worker, e.g. by a restart
+async def post_init(application: Application) -> None:
+    await post_init_commands(application)
+    shorten_queue.start(application.bot)
+    channel_registry.start(application.bot)
+    broadcaster.watch(application.bot)
+
+
+# Stop taking updates and stop background work while the Bot can still send:
+# close the HTTP server, wait for the updates being processed, then stop the
+# senders and flush new users and counters. Services that were never started
+# are skipped, so this serves both post_init variants.
+async def stop_services(application: Application) -> None:
+    await http_server.close()
+    if cluster_router is not None:
+        await cluster_router.close()
+    await broadcaster.stop()
+    await channel_fanout.stop()
+    await channel_registry.stop()
+    await api_key_validator.stop()
+    await shorten_queue.stop()
+    await dead_chats.stop()
+    await profiler.stop()
+    await known_users.stop()
+    await counters.stop()
+
+
+# Close the shortener connection pool and the MongoDB executor on shutdown
+async def shutdown(application: Application) -> None:
+    await shortener.close()
+    mongo.close()
+
+
+# Add the account and admin command handlers, all bot_chat.py runs; they need
+# the services started by post_init_commands
+def register_command_handlers(application: Application) -> None:
+    application.add_handler(CommandHandler("start", instrumented(start)))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CommandHandler("broadcast", instrumented(broadcast)))
+    application.add_handler(CommandHandler("broadcast_api", instrumented(broadcast_api)))
+    application.add_handler(CommandHandler("connect", instrumented(connect)))
+    application.add_handler(CommandHandler("disconnect", instrumented(disconnect)))
+    application.add_handler(CommandHandler("commands", instrumented(commands)))
+    application.add_handler(CommandHandler("view", instrumented(view)))
+    application.add_handler(CommandHandler("dead_chats", instrumented(dead_chats_command)))
+
+
+# Add every command and message handler, shared by both update delivery modes and the load-test harness
+def register_handlers(application: Application) -> None:
+    register_command_handlers(application)
+    application.add_handler(CommandHandler("set_channel", instrumented(set_channel)))
+    application.add_handler(CommandHandler("forward", instrumented(forward_message_to_user)))
+    application.add_handler(CommandHandler("cache_stats", instrumented(cache_stats)))
+    application.add_handler(CommandHandler("stats", instrumented(stats)))
+    application.add_handler(CommandHandler("profile", instrumented(profile)))
+    application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO, instrumented(admission.limit(handle_message))))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv"),
+        instrumented(admission.limit(handle_document))
+    ))
+
+
+# Main function to run the bot with the handlers added by `register` and the
+# background services started by `init`, which must be the ones those handlers
+# need; MongoDB is connected from `init`, so nothing touches the network before
+# the Application starts
+def main(register=register_handlers, init=post_init):
+    global cluster_router
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            logger.error("Webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET to be set")
+            return
+        # Updates arrive on the HTTP port, so no updater is needed; the cluster router
+        # dedupes them, sends them to the worker owning the user and runs them concurrently
+        application = (
+            Application.builder().token(TELEGRAM_TOKEN).updater(None)
+            .request(TracedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)).rate_limiter(send_scheduler)
+            .post_init(init).post_shutdown(shutdown).build()
+        )
+        cluster_router = ClusterRouter(application, update_claims, WEBHOOK_SECRET, UPDATE_CONCURRENCY)
+        http_server.route("POST", WEBHOOK_PATH, webhook_handler(application, WEBHOOK_SECRET, cluster_router))
+        http_server.route("POST", INTERNAL_UPDATES_PATH, webhook_handler(
+            application, WEBHOOK_SECRET, cluster_router, header="x-worker-secret", internal=True
+        ))
+        logger.info(f"Worker {WORKER_INDEX + 1} of {WORKER_COUNT}")
+    else:
+        if WORKER_COUNT > 1:
+            logger.error("Only one worker can poll for updates, use BOT_MODE=webhook to run several")
+            return
+        # Create an Application object
+        application = (
+            Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(UPDATE_CONCURRENCY)
+            .request(TracedRequest(connection_pool_size=TELEGRAM_CONNECTION_POOL_SIZE)).rate_limiter(send_scheduler)
+            .post_init(init).post_shutdown(shutdown).build()
         )
 
-        # Send success message
-        await update.message.reply_text(f"✅ Channel {channel_id} connected successfully!\nA test message was sent.")
-    
-    except Exception as e:
-        # If the message sending fails, inform the user
-        await update.message.reply_text(f"❌ Failed to connect to {channel_id}. Please make sure the bot has permission to send messages to this channel.")
-        logger.error(f"Error while connecting to {channel_id}: {e}")
-
+    register(application)
 
-# Main function to run the bot and the health check server
-def main():
-    # Test MongoDB connection
-    test_mongo_connection()
-
-    # Start the health check server in a separate thread
-    health_thread = threading.Thread(target=health_check_server)
-    health_thread.daemon = True
-    health_thread.start()
-
-    # Create an Application object
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-
-    # Add command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("broadcast", broadcast))
-    application.add_handler(CommandHandler("broadcast_api", broadcast_api))
-    application.add_handler(CommandHandler("connect", connect))
-    application.add_handler(CommandHandler("disconnect", disconnect))
-    application.add_handler(CommandHandler("commands", commands))
-    application.add_handler(CommandHandler("view", view))
-    application.add_handler(CommandHandler("set_channel", set_channel))
-    application.add_handler(MessageHandler(filters.TEXT | filters.PHOTO | filters.VIDEO, handle_message))
-
-    # Start polling for updates from Telegram
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        # Telegram updates arrive on the same HTTP server as the health checks
+        run_webhook(application, WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, WEBHOOK_SECRET, before_stop=stop_services)
+    else:
+        # Start polling for updates from Telegram
+        run_polling(application, before_stop=stop_services)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram.error import TelegramError
+
+from chats import DEAD_REASONS, failure_reason
+from cluster import WORKER_ID
+from scheduler import BULK
+
+
+logger = logging.getLogger(__name__)
+
+# Broadcast settings; send rates are enforced by the bot's SendScheduler
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "120"))
+
+# Channel fan-out settings
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "10"))
+
+OUTCOMES = ('delivered', 'failed', 'blocked', 'skipped')
+
+
+# Await send(), which is throttled and retried on RetryAfter by the bot's
+# SendScheduler. Chats known to be dead are skipped and, with `chats`, every
+# outcome is recorded. Returns one of OUTCOMES.
+async def deliver(send, chat_id, chats=None):
+    if chats is not None and chats.is_dead(chat_id):
+        return 'skipped'
+    try:
+        await send()
+        outcome, reason = 'delivered', 'delivered'
+    except TelegramError as e:
+        reason = failure_reason(e)
+        if reason in DEAD_REASONS:
+            outcome = 'blocked'
+        else:
+            outcome = 'failed'
+            logger.warning(f"Sending to {chat_id} failed: {e}")
+    if chats is not None:
+        await chats.record(chat_id, reason)
+    return outcome
+
+
+# Send the delivered/failed/blocked/skipped report for a finished job to the admin
+async def send_report(bot, chat_id, title, counts):
+    try:
+        await bot.send_message(
+            chat_id=chat_id,
+            text=(
+                f"{title}\n"
+                f"✅ Delivered: {counts['delivered']}\n"
+                f"❌ Failed: {counts['failed']}\n"
+                f"🚫 Blocked: {counts['blocked']}\n"
+                f"⏭ Skipped (unreachable): {counts['skipped']}"
+            )
+        )
+    except TelegramError as e:
+        logger.error(f"Error sending report to {chat_id}: {e}")
+
+
+# Another worker took over the job's lease
+class LeaseLost(Exception):
+    pass
+
+
+# Runs broadcasts as background jobs. Recipients are read in user_id order and
+# sent in chunks through a sender pool, in the scheduler's bulk lane; after every chunk the last
+# user_id and the outcome counters are checkpointed in the jobs collection, so a
+# job left 'running' by a restart resumes where it stopped. A job is only run by
+# the worker holding its lease, renewed before every chunk and every third of
+# BROADCAST_LEASE while a chunk is sent, so with several workers each chunk is
+# sent by one of them; an expired lease is taken over, and a worker that can no
+# longer renew stops sending. With `rate`, the bulk sends per second this worker
+# may make, chunks are cut to what it sends in a quarter of the lease, so a
+# checkpoint is written at least that often.
+# With `chats` (a chats.DeadChats), dead chats are skipped and outcomes recorded.
+class BroadcastEngine:
+    def __init__(self, jobs_collection, audiences, concurrency=BROADCAST_CONCURRENCY,
+                 chunk_size=BROADCAST_CHUNK_SIZE, chats=None, stats=None, rate=None):
+        self.jobs = jobs_collection
+        self.audiences = audiences
+        self.chats = chats
+        self.stats = stats
+        self.concurrency = concurrency
+        if rate is not None:
+            chunk_size = min(chunk_size, max(1, int(rate * BROADCAST_LEASE / 4)))
+        self.chunk_size = chunk_size
+        self._tasks = {}
+        self._watcher = None
+
+    # Create a job for the named audience and start sending in the background
+    async def start(self, bot, audience, text, admin_chat_id):
+        now = datetime.utcnow()
+        job = {
+            'audience': audience,
+            'text': text,
+            'admin_chat_id': admin_chat_id,
+            'status': 'running',
+            'last_user_id': None,
+            'lease_owner': WORKER_ID,
+            'lease_until': now + timedelta(seconds=BROADCAST_LEASE),
+            'created_at': now,
+            'updated_at': now,
+        }
+        job.update({outcome: 0 for outcome in OUTCOMES})
+        result = await self.jobs.insert_one(job)
+        job['_id'] = result.inserted_id
+        self._spawn(bot, job)
+        return job['_id']
+
+    # Take over every running job whose lease has expired, e.g. after a restart
+    async def resume(self, bot):
+        now = datetime.utcnow()
+        async for job in self.jobs.iterate({'status': 'running', '$or': [{'lease_until': {'$lt': now}}, {'lease_until': None}]}):
+            if job['_id'] not in self._tasks and await self._renew_lease(job):
+                logger.info(f"Resuming broadcast {job['_id']} after user {job['last_user_id']}")
+                self._spawn(bot, job)
+
+    # Look for abandoned jobs every half lease period
+    def watch(self, bot):
+        async def loop():
+            while True:
+                try:
+                    await self.resume(bot)
+                except Exception as e:
+                    logger.error(f"Error resuming broadcasts: {e}")
+                await asyncio.sleep(BROADCAST_LEASE / 2)
+
+        self._watcher = asyncio.create_task(loop())
+
+    # Cancel running jobs and wait for them to release their leases
+    async def stop(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _renew_lease(self, job):
+        now = datetime.utcnow()
+        result = await self.jobs.update_one(
+            {
+                '_id': job['_id'],
+                'status': 'running',
+                '$or': [{'lease_owner': WORKER_ID}, {'lease_until': {'$lt': now}}, {'lease_until': None}],
+            },
+            {'$set': {'lease_owner': WORKER_ID, 'lease_until': now + timedelta(seconds=BROADCAST_LEASE)}}
+        )
+        return result.matched_count == 1
+
+    # Renew the lease while a chunk is being sent; returns once it was lost
+    async def _keep_lease(self, job):
+        while True:
+            await asyncio.sleep(BROADCAST_LEASE / 3)
+            try:
+                if not await self._renew_lease(job):
+                    return
+            except Exception as e:
+                # The lease is still valid for two more tries
+                logger.warning(f"Error renewing the lease of broadcast {job['_id']}: {e}")
+
+    def _spawn(self, bot, job):
+        task = asyncio.create_task(self._run(bot, job))
+        self._tasks[job['_id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job['_id'], None))
+
+    async def _run(self, bot, job):
+        counts = {outcome: job.get(outcome, 0) for outcome in OUTCOMES}
+        query = {} if job['last_user_id'] is None else {'user_id': {'$gt': job['last_user_id']}}
+        chunk = []
+        try:
+            async for user in self.audiences[job['audience']].iterate(query, {'user_id': 1}, sort=[('user_id', 1)]):
+                chunk.append(user['user_id'])
+                if len(chunk) >= self.chunk_size:
+                    await self._send_chunk(bot, job, chunk, counts)
+                    chunk = []
+            if chunk:
+                await self._send_chunk(bot, job, chunk, counts)
+
+            result = await self.jobs.update_one(
+                {'_id': job['_id'], 'lease_owner': WORKER_ID},
+                {'$set': {'status': 'done', 'updated_at': datetime.utcnow()}}
+            )
+            if result.matched_count == 0:
+                raise LeaseLost()
+        except asyncio.CancelledError:
+            # Release the lease so another worker can resume straight away
+            await self.jobs.update_one(
+                {'_id': job['_id'], 'lease_owner': WORKER_ID},
+                {'$set': {'lease_until': datetime.utcnow()}}
+            )
+            raise
+        except LeaseLost:
+            logger.warning(f"Broadcast {job['_id']} was taken over by another worker")
+            return
+        except Exception as e:
+            # The job stays 'running' so the next start resumes from the last checkpoint
+            logger.error(f"Broadcast {job['_id']} interrupted: {e}")
+            return
+
+        await send_report(bot, job['admin_chat_id'], "📣 Broadcast finished!", counts)
+
+    async def _send_chunk(self, bot, job, chat_ids, counts):
+        if not await self._renew_lease(job):
+            raise LeaseLost()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        sends = asyncio.ensure_future(
+            asyncio.gather(*(self._deliver(bot, chat_id, job['text'], semaphore) for chat_id in chat_ids))
+        )
+        keeper = asyncio.ensure_future(self._keep_lease(job))
+        try:
+            await asyncio.wait({sends, keeper}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            keeper.cancel()
+            if not sends.done():
+                # Cancelled, or the lease was lost and another worker owns the rest
+                sends.cancel()
+                await asyncio.gather(sends, keeper, return_exceptions=True)
+        if sends.cancelled():
+            raise LeaseLost()
+        outcomes = sends.result()
+        for outcome in outcomes:
+            counts[outcome] += 1
+        if self.stats is not None:
+            self.stats.inc(**{f"broadcast_{outcome}": outcomes.count(outcome) for outcome in OUTCOMES})
+
+        await self.jobs.update_one(
+            {'_id': job['_id'], 'lease_owner': WORKER_ID},
+            {'$set': {'last_user_id': chat_ids[-1], 'updated_at': datetime.utcnow(), **counts}}
+        )
+
+    async def _deliver(self, bot, chat_id, text, semaphore):
+        async with semaphore:
+            return await deliver(lambda: bot.send_message(chat_id=chat_id, text=text, rate_limit_args=BULK),
+                                 chat_id, self.chats)
+
+
+# Copies one message to every channel the registry (a channels.ChannelRegistry)
+# knows to be writable. Channel ids are streamed from the cursor into a bounded
+# queue drained by a fixed pool of workers, so memory stays flat however many
+# channels there are; an unexpected error only fails its own channel. Copies go
+# in the scheduler's bulk lane, which also applies Telegram's per-chat limit.
+# Channels the bot lost access to are marked in the registry and skipped with
+# `chats`, as in BroadcastEngine.
+class ChannelFanout:
+    def __init__(self, registry, concurrency=FANOUT_CONCURRENCY, chats=None, stats=None):
+        self.registry = registry
+        self.chats = chats
+        self.stats = stats
+        self.concurrency = concurrency
+        self._tasks = set()
+
+    # Start copying from_chat_id/message_id to all channels in the background
+    def start(self, bot, from_chat_id, message_id, admin_chat_id):
+        task = asyncio.create_task(self._run(bot, from_chat_id, message_id, admin_chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot, from_chat_id, message_id, admin_chat_id):
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        counts = {outcome: 0 for outcome in OUTCOMES}
+        workers = [
+            asyncio.create_task(self._worker(bot, queue, from_chat_id, message_id, counts))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            async for channel_id in self.registry.writable():
+                await queue.put(channel_id)
+            await queue.join()
+        except Exception as e:
+            logger.error(f"Channel fan-out interrupted: {e}")
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+        await send_report(bot, admin_chat_id, "📤 Channel forward finished!", counts)
+
+    async def _worker(self, bot, queue, from_chat_id, message_id, counts):
+        while True:
+            chat_id = await queue.get()
+            try:
+                try:
+                    outcome = await deliver(
+                        lambda: bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_id,
+                                                 rate_limit_args=BULK),
+                        chat_id,
+                        self.chats
+                    )
+                except Exception as e:
+                    # Anything but a Telegram error, e.g. from the network or Mongo;
+                    # count it for this channel and keep the worker for the others
+                    logger.error(f"Error forwarding to channel {chat_id}: {e}")
+                    outcome = 'failed'
+                counts[outcome] += 1
+                if outcome == 'blocked':
+                    await self.registry.lost(chat_id, 'blocked')
+                if self.stats is not None:
+                    self.stats.inc(**{f"forward_{outcome}": 1})
+            finally:
+                queue.task_done()
@@ -0,0 +1,84 @@
+import asyncio
+import collections
+import csv
+import io
+import logging
+import os
+import time
+
+from links import find_links, terabox_key
+
+
+logger = logging.getLogger(__name__)
+
+# Bulk upload settings
+BULK_MAX_FILE_SIZE = int(os.getenv("BULK_MAX_FILE_SIZE", str(2 * 1024 * 1024)))
+BULK_MAX_LINKS = int(os.getenv("BULK_MAX_LINKS", "2000"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "20"))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "3"))
+
+
+# A csv cell may be as large as the whole upload, e.g. a line of links in one quoted cell
+csv.field_size_limit(max(csv.field_size_limit(), BULK_MAX_FILE_SIZE))
+
+
+# Yield the links of an uploaded file line by line, so the file is never split
+# into one big list. A .csv file (`csv_cells`) is read cell by cell, anything
+# else as free text, however long its lines are.
+def iter_file_links(stream, max_links=BULK_MAX_LINKS, csv_cells=False):
+    text = io.TextIOWrapper(stream, encoding="utf-8", errors="replace", newline="")
+    rows = csv.reader(text) if csv_cells else ([line] for line in text)
+    count = 0
+    for row in rows:
+        for cell in row:
+            for link in find_links(cell):
+                yield link
+                count += 1
+                if count >= max_links:
+                    return
+
+
+# Shorten every link from `links` with at most BULK_CONCURRENCY calls in flight
+# and write "original,shortened,status" rows to `out` in input order.
+# shorten(long_url) returns the shortened url, None or raises; long_url(key)
+# builds the url to shorten for a Terabox key. on_progress(done) is awaited at
+# most every BULK_PROGRESS_INTERVAL seconds. Returns a dict of status counts.
+async def shorten_links_to_csv(links, shorten, long_url, out, on_progress=None):
+    writer = csv.writer(out)
+    writer.writerow(["original", "shortened", "status"])
+    counts = {"shortened": 0, "failed": 0, "skipped": 0}
+    last_progress = time.monotonic()
+
+    async def shorten_one(link):
+        key = terabox_key(link)
+        if not key:
+            return link, "", "skipped"
+        try:
+            shortened_url = await shorten(long_url(key))
+        except Exception as e:
+            logger.warning(f"Bulk shortening of {link} failed: {e}")
+            shortened_url = None
+        return link, shortened_url or "", "shortened" if shortened_url else "failed"
+
+    async def write_next():
+        nonlocal last_progress
+        row = await pending.popleft()
+        writer.writerow(row)
+        counts[row[2]] += 1
+        if on_progress and time.monotonic() - last_progress >= BULK_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await on_progress(sum(counts.values()))
+
+    # Sliding window: keep BULK_CONCURRENCY links in flight, write rows as the oldest finishes
+    pending = collections.deque()
+    try:
+        for link in links:
+            pending.append(asyncio.ensure_future(shorten_one(link)))
+            if len(pending) >= BULK_CONCURRENCY:
+                await write_next()
+        while pending:
+            await write_next()
+    finally:
+        for task in pending:
+            task.cancel()
+    return counts
@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+# Shortened url cache settings
+SHORT_URL_CACHE_SIZE = int(os.getenv("SHORT_URL_CACHE_SIZE", "50000"))
+SHORT_URL_CACHE_TTL = int(os.getenv("SHORT_URL_CACHE_TTL", str(7 * 24 * 3600)))
+
+# API key lookup cache settings, "not connected" answers expire sooner
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "100000"))
+API_KEY_CACHE_TTL = int(os.getenv("API_KEY_CACHE_TTL", "600"))
+API_KEY_CACHE_NEGATIVE_TTL = int(os.getenv("API_KEY_CACHE_NEGATIVE_TTL", "30"))
+
+
+# Bounded in-process LRU cache whose entries expire after a ttl
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Two-tier cache of shortened urls keyed by (api_key, long_url).
+# The first tier is an in-process TTLCache, the optional second tier a Mongo
+# collection with a TTL index. Concurrent misses for one key share one lookup.
+class ShortUrlCache:
+    def __init__(self, collection=None, maxsize=SHORT_URL_CACHE_SIZE, ttl=SHORT_URL_CACHE_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize, ttl)
+        self._pending = {}
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    # Return the shortened url from the cache, or call shorten(api_key, long_url) on a miss
+    async def get_or_shorten(self, api_key, long_url, shorten):
+        return await self._get((api_key, long_url), lambda: self._load(api_key, long_url, shorten))
+
+    # The cached url for key, or the result of load(), shared with concurrent misses for key
+    async def _get(self, key, load):
+        shortened_url = self.memory.get(key)
+        if shortened_url is not None:
+            self.hits += 1
+            return shortened_url
+
+        task = self._pending.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(load())
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    # Shorten many urls through the cache, results keep the order of long_urls.
+    # A url whose shortening raised gets the exception in its place. With
+    # shorten_batch(api_key, long_urls) taking up to max_batch urls, the urls
+    # missing from memory are looked up in chunks of max_batch, one upstream call
+    # per chunk for those not in Mongo either, instead of one call each; a url
+    # left alone in the last chunk takes the single-url path.
+    async def shorten_many(self, api_key, long_urls, shorten, shorten_batch=None, max_batch=1):
+        loads = {}
+        if shorten_batch is not None and max_batch > 1:
+            missing = [url for url in dict.fromkeys(long_urls)
+                       if (api_key, url) not in self.memory and (api_key, url) not in self._pending]
+            for start in range(0, len(missing) - 1, max_batch):
+                chunk = missing[start:start + max_batch]
+                batch = asyncio.ensure_future(self._load_batch(api_key, chunk, shorten_batch))
+                # Read the error even if every url found another pending lookup meanwhile
+                batch.add_done_callback(lambda task: task.cancelled() or task.exception())
+                for url in chunk:
+                    loads[url] = functools.partial(self._from_batch, batch, url)
+        return await asyncio.gather(
+            *(self._get((api_key, url), loads.get(url) or functools.partial(self._load, api_key, url, shorten))
+              for url in long_urls),
+            return_exceptions=True
+        )
+
+    @staticmethod
+    async def _from_batch(batch, url):
+        return (await asyncio.shield(batch)).get(url)
+
+    async def _load(self, api_key, long_url, shorten):
+        key = (api_key, long_url)
+        shortened_url = await self._find_persistent(api_key, long_url)
+        if shortened_url is not None:
+            self.persistent_hits += 1
+            self.memory.set(key, shortened_url)
+            return shortened_url
+
+        self.misses += 1
+        self.upstream_calls += 1
+        shortened_url = await shorten(api_key, long_url)
+        # Failed shortenings are not cached so the next message retries them
+        if shortened_url is not None:
+            self.memory.set(key, shortened_url)
+            await self._save_persistent(api_key, long_url, shortened_url)
+        return shortened_url
+
+    # Like _load for several urls, with one shorten_batch call for those not in Mongo. Returns url -> result.
+    async def _load_batch(self, api_key, long_urls, shorten_batch):
+        found = await asyncio.gather(*(self._find_persistent(api_key, url) for url in long_urls))
+        results = {}
+        for url, shortened_url in zip(long_urls, found):
+            if shortened_url is not None:
+                self.persistent_hits += 1
+                self.memory.set((api_key, url), shortened_url)
+                results[url] = shortened_url
+
+        upstream = [url for url in long_urls if url not in results]
+        if not upstream:
+            return results
+        self.misses += len(upstream)
+        self.upstream_calls += 1
+        shortened = await shorten_batch(api_key, upstream)
+        saves = []
+        for url, shortened_url in zip(upstream, shortened):
+            results[url] = shortened_url
+            if shortened_url is not None:
+                self.memory.set((api_key, url), shortened_url)
+                saves.append(self._save_persistent(api_key, url, shortened_url))
+        await asyncio.gather(*saves)
+        return results
+
+    async def _find_persistent(self, api_key, long_url):
+        if self.collection is None:
+            return None
+        try:
+            doc = await self.collection.find_one({'api_key': api_key, 'long_url': long_url})
+        except Exception as e:
+            logger.error(f"Error reading shortened url cache: {e}")
+            return None
+        return doc.get('short_url') if doc else None
+
+    async def _save_persistent(self, api_key, long_url, shortened_url):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.update_one(
+                {'api_key': api_key, 'long_url': long_url},
+                {'$set': {'short_url': shortened_url, 'created_at': datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error writing shortened url cache: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'memory_hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'upstream_calls': self.upstream_calls,
+            'hit_rate': (self.hits + self.persistent_hits) / lookups if lookups else 0.0,
+            'size': len(self.memory),
+        }
+
+
+# Cache of user_id -> api_id in front of the api_id collection.
+# Writers update it through set() and evict(), users without a key are
+# cached as a negative entry with a short ttl. While a user's key is being read
+# from Mongo, set() and evict() bump the user's generation, and a read that
+# started before is returned but not cached, so it cannot bring back a key
+# that was just removed or hide one that was just connected.
+class ApiKeyCache:
+    _NOT_CONNECTED = ""
+
+    def __init__(self, collection, maxsize=API_KEY_CACHE_SIZE, ttl=API_KEY_CACHE_TTL,
+                 negative_ttl=API_KEY_CACHE_NEGATIVE_TTL):
+        self.collection = collection
+        self.negative_ttl = negative_ttl
+        self.memory = TTLCache(maxsize, ttl)
+        # user_id -> [generation, reads in flight], only kept while a read is in flight
+        self._loading = {}
+
+    # Return the user's api_id, or None if the user has not connected one
+    async def get(self, user_id):
+        api_id = self.memory.get(user_id)
+        if api_id is not None:
+            return api_id or None
+        entry = self._loading.get(user_id)
+        if entry is None:
+            entry = self._loading[user_id] = [0, 0]
+        entry[1] += 1
+        generation = entry[0]
+        try:
+            user = await self.collection.find_one({"user_id": user_id})
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._loading.pop(user_id, None)
+        api_id = user.get("api_id") if user else None
+        if entry[0] == generation:
+            if api_id:
+                self.memory.set(user_id, api_id)
+            else:
+                self.memory.set(user_id, self._NOT_CONNECTED, ttl=self.negative_ttl)
+        return api_id or None
+
+    def set(self, user_id, api_id):
+        self._invalidate(user_id)
+        self.memory.set(user_id, api_id)
+
+    def evict(self, user_id):
+        self._invalidate(user_id)
+        self.memory.pop(user_id)
+
+    def _invalidate(self, user_id):
+        entry = self._loading.get(user_id)
+        if entry is not None:
+            entry[0] += 1
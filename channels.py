@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from telegram.constants import ChatMemberStatus, ChatType
+from telegram.error import BadRequest, Forbidden, TelegramError
+
+from cache import TTLCache
+from ratelimit import TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# How long a channel's permission check is trusted, how often stale channels are
+# looked for, and how many permission checks per second revalidation may make
+CHANNEL_CHECK_TTL = int(os.getenv("CHANNEL_CHECK_TTL", str(24 * 3600)))
+CHANNEL_REVALIDATE_INTERVAL = float(os.getenv("CHANNEL_REVALIDATE_INTERVAL", "600"))
+CHANNEL_CHECK_RATE = float(os.getenv("CHANNEL_CHECK_RATE", "1"))
+
+WRITABLE = 'writable'
+NOT_WRITABLE = 'not_writable'
+
+
+# Whether the bot can post in channel_id, from its own membership. Returns
+# (writable, detail); raises TelegramError when the chat could not be checked now.
+async def probe(bot, channel_id):
+    try:
+        member = await bot.get_chat_member(channel_id, bot.id)
+    except (Forbidden, BadRequest) as e:
+        # Not a member, the chat does not exist or its members cannot be listed
+        return False, e.message
+    status = str(member.status)
+    if member.status == ChatMemberStatus.OWNER:
+        return True, status
+    if member.status == ChatMemberStatus.ADMINISTRATOR:
+        # can_post_messages is only set in channels, admins can always write in groups
+        return member.can_post_messages is not False, status
+    if member.status == ChatMemberStatus.MEMBER:
+        # Plain members can write in groups but not in channels
+        chat = await bot.get_chat(channel_id)
+        return chat.type != ChatType.CHANNEL, status
+    if member.status == ChatMemberStatus.RESTRICTED:
+        return bool(member.can_send_messages), status
+    return False, status
+
+
+# Registered channels in the user_channels collection, with the bot's permission
+# state cached on each document ('state', 'detail', 'checked_at'). Checks are
+# also remembered in memory per channel for CHANNEL_CHECK_TTL, so registering a
+# channel that is known to be writable costs no Telegram call. A background task
+# revalidates documents whose check is older than that, taking a token from a
+# CHANNEL_CHECK_RATE bucket for every check; several workers share the work by
+# claiming each document with a conditional update. Fan-outs only read channels
+# in the WRITABLE state. With `chats` (a chats.DeadChats), a channel found
+# writable again is revived.
+class ChannelRegistry:
+    def __init__(self, collection, chats=None, ttl=CHANNEL_CHECK_TTL, interval=CHANNEL_REVALIDATE_INTERVAL,
+                 rate=CHANNEL_CHECK_RATE):
+        self.collection = collection
+        self.chats = chats
+        self.ttl = ttl
+        self.interval = interval
+        self.bucket = TokenBucket(rate)
+        self.results = TTLCache(maxsize=100000, ttl=ttl)
+        self._task = None
+
+    # The (writable, detail) state of channel_id, from the cache when it was
+    # writable; a channel found not writable is checked again, it may have been fixed
+    async def check(self, bot, channel_id):
+        result = self.results.get(channel_id)
+        if result is not None and result[0]:
+            return result
+        result = await probe(bot, channel_id)
+        self.results.set(channel_id, result)
+        return result
+
+    # Check channel_id and make it the user's channel when the bot can post in it.
+    # Returns (writable, detail, whether the user had no channel before).
+    async def register(self, bot, user_id, channel_id):
+        writable, detail = await self.check(bot, channel_id)
+        if not writable:
+            return False, detail, False
+        result = await self.collection.update_one(
+            {'user_id': user_id},
+            {'$set': {'user_id': user_id, 'channel_id': channel_id}},
+            upsert=True
+        )
+        # Marks every document of the channel writable and revives it in `chats`,
+        # a channel re-added after losing access is forwarded to again at once
+        await self.save(channel_id, True, detail)
+        return True, detail, result.upserted_id is not None
+
+    # The ids of the channels known to be writable, streamed from the collection
+    async def writable(self):
+        async for channel in self.collection.iterate({'state': WRITABLE}, {'channel_id': 1}):
+            yield channel['channel_id']
+
+    # Record a check of channel_id on every document registering it
+    async def save(self, channel_id, writable, detail):
+        self.results.set(channel_id, (writable, detail))
+        await self.collection.update_many(
+            {'channel_id': channel_id},
+            {'$set': {'state': WRITABLE if writable else NOT_WRITABLE, 'detail': detail,
+                      'checked_at': datetime.utcnow()}}
+        )
+        if writable and self.chats is not None:
+            await self.chats.revive(channel_id)
+
+    # A send found that the bot can no longer post in channel_id
+    async def lost(self, channel_id, reason):
+        try:
+            await self.save(channel_id, False, reason)
+        except Exception as e:
+            logger.error(f"Error marking channel {channel_id} not writable: {e}")
+
+    def start(self, bot):
+        async def loop():
+            while True:
+                try:
+                    checked = await self.revalidate(bot)
+                    if checked:
+                        logger.info(f"Revalidated {checked} channels")
+                except Exception as e:
+                    logger.error(f"Error revalidating channels: {e}")
+                await asyncio.sleep(self.interval)
+
+        self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    # Check every channel whose last check is older than the ttl. Returns the number checked.
+    async def revalidate(self, bot):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        stale = {'channel_id': {'$exists': True}, '$or': [{'checked_at': {'$lt': cutoff}}, {'checked_at': None}]}
+        checked = 0
+        async for doc in self.collection.iterate(stale, {'channel_id': 1, 'checked_at': 1}):
+            # Another worker, or a document of the same channel, may have checked it meanwhile
+            claim = await self.collection.update_one(
+                {'_id': doc['_id'], 'checked_at': doc.get('checked_at')},
+                {'$set': {'checked_at': datetime.utcnow()}}
+            )
+            if claim.matched_count == 0:
+                continue
+            channel_id = doc['channel_id']
+            await self.bucket.acquire()
+            try:
+                writable, detail = await probe(bot, channel_id)
+            except TelegramError as e:
+                # Not checked, leave it stale for the next round
+                logger.warning(f"Error checking channel {channel_id}: {e}")
+                await self.collection.update_one({'_id': doc['_id']}, {'$set': {'checked_at': doc.get('checked_at')}})
+                continue
+            await self.save(channel_id, writable, detail)
+            checked += 1
+        return checked
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+
+logger = logging.getLogger(__name__)
+
+# How often every worker reloads the dead chats, to pick up those found by other workers
+DEAD_CHAT_REFRESH_INTERVAL = float(os.getenv("DEAD_CHAT_REFRESH_INTERVAL", "300"))
+
+# Delivery outcomes that mean the chat cannot be reached until it talks to the bot again
+DEAD_REASONS = ('forbidden', 'chat_not_found')
+
+
+# The recorded outcome for a failed send: 'forbidden' (blocked by the user,
+# deactivated account, kicked from the channel), 'chat_not_found', 'retry_after'
+# or 'failed' for anything else
+def failure_reason(error):
+    if isinstance(error, Forbidden):
+        return 'forbidden'
+    if isinstance(error, BadRequest) and "chat not found" in error.message.lower():
+        return 'chat_not_found'
+    if isinstance(error, RetryAfter):
+        return 'retry_after'
+    return 'failed'
+
+
+# Reachability of the chats the bot sends to. Outcomes are recorded per chat in
+# a collection indexed on state; chats whose last outcome is in DEAD_REASONS are
+# 'dead' and kept in an in-memory set, warmed at startup and refreshed every
+# DEAD_CHAT_REFRESH_INTERVAL, so broadcasts and fan-outs skip them without
+# spending a request. Successful sends are only written when they revive a chat.
+class DeadChats:
+    def __init__(self, collection, refresh_interval=DEAD_CHAT_REFRESH_INTERVAL):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.dead = set()
+        self._task = None
+        self._recheck = None
+
+    def start(self):
+        async def loop():
+            while True:
+                await self.load()
+                await asyncio.sleep(self.refresh_interval)
+
+        self._task = asyncio.create_task(loop())
+
+    # Stop the refresh loop and a running recheck
+    async def stop(self):
+        tasks = [task for task in (self._task, self._recheck) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def load(self):
+        try:
+            dead = set()
+            async for chat in self.collection.iterate({'state': 'dead'}, {'_id': 1}, batch_size=5000):
+                dead.add(chat['_id'])
+            self.dead = dead
+        except Exception as e:
+            logger.error(f"Error loading dead chats: {e}")
+
+    def is_dead(self, chat_id):
+        return chat_id in self.dead
+
+    # Record the outcome of a send to chat_id, 'delivered' or a failure_reason()
+    async def record(self, chat_id, outcome):
+        if outcome == 'delivered':
+            await self.revive(chat_id)
+            return
+        now = datetime.utcnow()
+        update = {'$set': {'last_outcome': outcome, 'updated_at': now}, '$inc': {f'outcomes.{outcome}': 1}}
+        if outcome in DEAD_REASONS:
+            self.dead.add(chat_id)
+            update['$set'].update(state='dead', dead_since=now)
+        else:
+            update['$setOnInsert'] = {'state': 'reachable'}
+        try:
+            await self.collection.update_one({'_id': chat_id}, update, upsert=True)
+        except Exception as e:
+            logger.error(f"Error recording outcome {outcome} for chat {chat_id}: {e}")
+
+    # Mark a dead chat reachable again, e.g. when the user writes to the bot.
+    # Returns whether the chat was dead.
+    async def revive(self, chat_id):
+        if chat_id not in self.dead:
+            return False
+        self.dead.discard(chat_id)
+        try:
+            await self.collection.update_one(
+                {'_id': chat_id},
+                {'$set': {'state': 'reachable', 'last_outcome': 'delivered', 'updated_at': datetime.utcnow()}}
+            )
+        except Exception as e:
+            logger.error(f"Error reviving chat {chat_id}: {e}")
+        return True
+
+    # Number of dead chats by last outcome
+    async def counts(self):
+        counts = {reason: 0 for reason in DEAD_REASONS}
+        async for chat in self.collection.iterate({'state': 'dead'}, {'last_outcome': 1}, batch_size=5000):
+            counts[chat.get('last_outcome')] = counts.get(chat.get('last_outcome'), 0) + 1
+        return counts
+
+    # Delete the dead chats from the audience collections, given as (collection, chat id field)
+    # pairs. The chats stay dead, so they are skipped if they turn up again. Returns the number
+    # deleted from each collection, in the order of audiences.
+    async def purge(self, audiences, batch_size=500):
+        dead = list(self.dead)
+        deleted = [0] * len(audiences)
+        for start in range(0, len(dead), batch_size):
+            batch = dead[start:start + batch_size]
+            for i, (collection, field) in enumerate(audiences):
+                result = await collection.delete_many({field: {'$in': batch}})
+                deleted[i] += result.deleted_count
+        return deleted
+
+    # Probe every dead chat with probe(chat_id), e.g. a chat action sent in the
+    # scheduler's bulk lane; chats that answer are revived. Returns (revived, still dead).
+    async def recheck(self, probe):
+        revived = still_dead = 0
+        for chat_id in list(self.dead):
+            try:
+                await probe(chat_id)
+            except TelegramError as e:
+                if failure_reason(e) not in DEAD_REASONS:
+                    logger.warning(f"Rechecking chat {chat_id} failed: {e}")
+                still_dead += 1
+                continue
+            await self.revive(chat_id)
+            revived += 1
+        return revived, still_dead
+
+    # Run recheck(probe) in the background, then await report(revived, still_dead).
+    # Returns False when a recheck is already running.
+    def start_recheck(self, probe, report):
+        if self._recheck is not None and not self._recheck.done():
+            return False
+
+        async def run():
+            try:
+                await report(*await self.recheck(probe))
+            except Exception as e:
+                logger.error(f"Error rechecking unreachable chats: {e}")
+
+        self._recheck = asyncio.create_task(run())
+        return True
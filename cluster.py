@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime
+
+import httpx
+from pymongo.errors import DuplicateKeyError
+
+from metrics import Counter
+
+
+logger = logging.getLogger(__name__)
+
+# Worker identity and sharding: worker WORKER_INDEX of WORKER_COUNT owns the
+# users with user_id % WORKER_COUNT == WORKER_INDEX. WORKER_PEERS lists the
+# base url of every worker by index, e.g. http://bot-0:8000,http://bot-1:8000
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_PEERS = [peer.strip().rstrip("/") for peer in os.getenv("WORKER_PEERS", "").split(",") if peer.strip()]
+INTERNAL_UPDATES_PATH = "/internal/updates"
+UPDATE_CLAIM_TTL = int(os.getenv("UPDATE_CLAIM_TTL", str(24 * 3600)))
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "5"))
+
+DUPLICATE_UPDATES = Counter("bot_duplicate_updates_total", "Updates dropped because another delivery was claimed")
+FORWARDED_UPDATES = Counter("bot_forwarded_updates_total", "Updates forwarded to the owning worker", ["outcome"])
+
+
+# Exactly-once claims on update ids, backed by a collection with a unique _id
+# and a TTL index; the first worker to insert an update id processes it.
+class UpdateClaims:
+    def __init__(self, collection, ttl=UPDATE_CLAIM_TTL):
+        self.collection = collection
+        self.ttl = ttl
+
+    async def claim(self, update_id):
+        try:
+            await self.collection.insert_one({'_id': update_id, 'worker': WORKER_ID, 'claimed_at': datetime.utcnow()})
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            # Processing twice is better than dropping the update while Mongo is unavailable
+            logger.error(f"Error claiming update {update_id}, processing it anyway: {e}")
+            return True
+
+
+# The user an update belongs to, used as both shard key and ordering key
+def update_owner(update):
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return 0
+
+
+# Routes webhook updates across workers. An update for a user owned by another
+# worker is forwarded there; the owning worker claims the update id, then
+# processes it with the updates of the same user strictly in arrival order and
+# updates of different users concurrently, up to `concurrency` at a time.
+class ClusterRouter:
+    def __init__(self, application, claims, secret, concurrency, worker_index=WORKER_INDEX,
+                 worker_count=WORKER_COUNT, peers=WORKER_PEERS):
+        self.application = application
+        self.claims = claims
+        self.secret = secret
+        self.concurrency = concurrency
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.peers = peers
+        self._locks = {}
+        self._tasks = set()
+        self._semaphore = None
+        self._client = None
+
+    def shard_for(self, update):
+        return update_owner(update) % self.worker_count
+
+    # Entry point for updates received from Telegram
+    async def route(self, update, body):
+        shard = self.shard_for(update)
+        if shard != self.worker_index and shard < len(self.peers):
+            if await self._forward(self.peers[shard], body):
+                return
+        await self.accept(update)
+
+    # Entry point for updates this worker owns, from Telegram or from a peer
+    async def accept(self, update):
+        if not await self.claims.claim(update.update_id):
+            DUPLICATE_UPDATES.inc()
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        owner = update_owner(update)
+        entry = self._locks.get(owner)
+        if entry is None:
+            entry = self._locks[owner] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        task = asyncio.create_task(self._process(owner, entry, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, owner, entry, update):
+        try:
+            async with entry[0]:
+                async with self._semaphore:
+                    await self.application.process_update(update)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(owner, None)
+
+    async def _forward(self, peer, body):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=FORWARD_TIMEOUT)
+        try:
+            response = await self._client.post(
+                peer + INTERNAL_UPDATES_PATH, content=body,
+                headers={"Content-Type": "application/json", "X-Worker-Secret": self.secret}
+            )
+            response.raise_for_status()
+            FORWARDED_UPDATES.inc(outcome="ok")
+            return True
+        except httpx.HTTPError as e:
+            # Keep the update rather than lose it, at the cost of ordering for this user
+            FORWARDED_UPDATES.inc(outcome="failed")
+            logger.error(f"Error forwarding update to {peer}, processing it here: {e}")
+            return False
+
+    # Wait for in-flight updates and close the peer connection pool
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,170 @@
+import asyncio
+import functools
+import itertools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+from metrics import MONGO_LATENCY, MONGO_ERRORS
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+# Connection pool, executor and timeout settings for MongoDB
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_EXECUTOR_WORKERS = int(os.getenv("MONGO_EXECUTOR_WORKERS", "16"))
+MONGO_OP_TIMEOUT = float(os.getenv("MONGO_OP_TIMEOUT", "5"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+
+
+# Runs blocking pymongo calls on a bounded thread pool so handlers never block the event loop.
+# The client is created by connect() on first use, so importing this module does no I/O.
+class AsyncMongo:
+    def __init__(self, connect, workers=MONGO_EXECUTOR_WORKERS, timeout=MONGO_OP_TIMEOUT):
+        self._connect = connect
+        self._client = None
+        self._lock = threading.Lock()
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mongo")
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return self._client
+
+    # Create the client on the executor (a mongodb+srv uri means DNS lookups) and ping
+    # the server. Returns False instead of raising, so startup goes on without Mongo.
+    async def connect(self):
+        try:
+            await self.run(lambda: self.client)
+            await self.ping()
+            logger.info("MongoDB connection successful")
+            return True
+        except Exception as e:
+            logger.error(f"Error connecting to MongoDB: {e}")
+            return False
+
+    # Run fn(*args, **kwargs) on the executor, raising asyncio.TimeoutError after timeout seconds
+    async def run(self, fn, *args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+
+    # Like run(), recording latency and errors under the collection/operation labels
+    # and a mongo.<collection>.<operation> span of the current update
+    async def timed(self, collection, operation, fn, *args, **kwargs):
+        try:
+            with MONGO_LATENCY.time(collection=collection, operation=operation), span(f"mongo.{collection}.{operation}"):
+                return await self.run(fn, *args, **kwargs)
+        except Exception:
+            MONGO_ERRORS.inc(collection=collection, operation=operation)
+            raise
+
+    async def ping(self, timeout=None):
+        return await self.timed('admin', 'ping', lambda: self.client.admin.command('ping'), timeout=timeout)
+
+    def collection(self, database, name):
+        return AsyncCollection(self, database, name)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self._client is not None:
+            self._client.close()
+
+
+# Awaitable wrapper around a pymongo collection, the raw collection stays available as .sync.
+# Operations resolve .sync on the executor, so the client is never created on the event
+# loop, where a mongodb+srv uri would block every chat on its DNS lookups.
+class AsyncCollection:
+    def __init__(self, mongo, database, name):
+        self.mongo = mongo
+        self.database = database
+        self.name = name
+
+    @property
+    def sync(self):
+        return self.mongo.client[self.database][self.name]
+
+    # Run the pymongo method `operation` of the collection on the executor
+    async def _call(self, operation, *args, **kwargs):
+        return await self.mongo.timed(self.name, operation, lambda: getattr(self.sync, operation)(*args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self._call('find_one', *args, **kwargs)
+
+    # Iterate a query in batches fetched on the executor so large result sets stream
+    async def iterate(self, *args, batch_size=500, **kwargs):
+        cursor = None
+
+        def fetch():
+            nonlocal cursor
+            if cursor is None:
+                cursor = self.sync.find(*args, **kwargs).batch_size(batch_size)
+            return list(itertools.islice(cursor, batch_size))
+
+        try:
+            while True:
+                batch = await self.mongo.timed(self.name, 'find', fetch)
+                if not batch:
+                    break
+                for doc in batch:
+                    yield doc
+        finally:
+            if cursor is not None:
+                cursor.close()
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._call('insert_one', *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._call('update_one', *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._call('update_many', *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._call('bulk_write', *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._call('delete_one', *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._call('delete_many', *args, **kwargs)
+
+
+# A socket_timeout of None waits on the server as long as it takes
+def create_client(socket_timeout=MONGO_OP_TIMEOUT):
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=int(socket_timeout * 1000) if socket_timeout is not None else None,
+    )
+
+
+# MongoDB setup, nothing connects until the first operation or mongo.connect()
+mongo = AsyncMongo(create_client)
+# Client for migrations.py: index builds and counts on large collections run far
+# longer than MONGO_OP_TIMEOUT, so it has no socket timeout and MIGRATION_TIMEOUT
+# bounds the whole run instead
+migration_mongo = AsyncMongo(functools.partial(create_client, socket_timeout=None), workers=1)
+user_collection = mongo.collection('telegram_bot', 'users')
+api_collection = mongo.collection('telegram_bot', 'api_id')
+user_channels_collection = mongo.collection('telegram_bot', 'user_channels')  # New collection for storing user channels
+short_url_collection = mongo.collection('telegram_bot', 'short_urls')  # Persistent tier of the shortened url cache
+broadcast_jobs_collection = mongo.collection('telegram_bot', 'broadcast_jobs')  # Broadcast progress checkpoints
+update_claims_collection = mongo.collection('telegram_bot', 'update_claims')  # Exactly-once update claims across workers
+chat_status_collection = mongo.collection('telegram_bot', 'chat_status')  # Delivery outcomes and reachability per chat
+stats_collection = mongo.collection('telegram_bot', 'stats')  # /stats totals and daily rollups
+shorten_jobs_collection = mongo.collection('telegram_bot', 'shorten_jobs')  # Durable queue of link shortening jobs
+schema_collection = mongo.collection('telegram_bot', 'schema')  # Applied migration version, see migrations.py
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from datetime import datetime, timedelta
+
+from cluster import WORKER_ID
+from metrics import Counter, Gauge, Histogram
+
+
+logger = logging.getLogger(__name__)
+
+# Shorten job settings: worker pool size, attempts before giving up, the first
+# retry delay (doubled on every attempt, up to SHORTEN_MAX_RETRY_DELAY), how long
+# a claimed job is leased, how often Mongo is polled for due jobs and how long
+# finished jobs are kept
+SHORTEN_WORKERS = int(os.getenv("SHORTEN_WORKERS", "32"))
+SHORTEN_MAX_ATTEMPTS = int(os.getenv("SHORTEN_MAX_ATTEMPTS", "5"))
+SHORTEN_RETRY_DELAY = float(os.getenv("SHORTEN_RETRY_DELAY", "5"))
+SHORTEN_MAX_RETRY_DELAY = float(os.getenv("SHORTEN_MAX_RETRY_DELAY", "300"))
+SHORTEN_JOB_LEASE = int(os.getenv("SHORTEN_JOB_LEASE", "120"))
+SHORTEN_POLL_INTERVAL = float(os.getenv("SHORTEN_POLL_INTERVAL", "5"))
+SHORTEN_JOB_RETENTION = int(os.getenv("SHORTEN_JOB_RETENTION", str(24 * 3600)))
+
+SHORTEN_JOBS = Counter("bot_shorten_jobs_total", "Finished shorten job attempts", ["outcome"])
+SHORTEN_JOB_DELAY = Histogram("bot_shorten_job_delay_seconds", "Time from enqueueing a shorten job to its first run")
+SHORTEN_JOBS_LOCAL = Gauge("bot_shorten_jobs_local", "Shorten jobs waiting in this worker's queue")
+
+
+# Raised by a job handler to run the job again later
+class RetryJob(Exception):
+    pass
+
+
+# Jobs that may be claimed: queued ones that are due, and running ones whose worker lost its lease
+def claimable(now):
+    return {'$or': [
+        {'status': 'queued', 'next_attempt_at': {'$lte': now}},
+        {'status': 'running', 'lease_until': {'$lt': now}},
+    ]}
+
+
+# Durable queue of link shortening jobs in a Mongo collection, run by a pool of
+# workers with bounded concurrency. enqueue() stores the job and hands it to the
+# local workers through an in-memory queue; when that is full the job waits in
+# Mongo and is picked up by the poller, which also finds retries that are due and
+# jobs whose worker died. Jobs of one chat run one at a time in creation order:
+# locally a job waits behind the chat's running job, and a job is only claimed
+# once no older job of its chat is queued or running in any worker. A worker
+# claims a job by leasing it with a conditional update, so each attempt runs on
+# one worker, then awaits handler(bot, job, final):
+# RetryJob or any other error reschedules the job with exponential backoff, and
+# `final` tells the handler that this is the last attempt. Delivery is at least
+# once, a worker dying between sending and marking the job done sends it again.
+class ShortenQueue:
+    def __init__(self, collection, handler, workers=SHORTEN_WORKERS, max_attempts=SHORTEN_MAX_ATTEMPTS,
+                 retry_delay=SHORTEN_RETRY_DELAY, max_retry_delay=SHORTEN_MAX_RETRY_DELAY,
+                 lease=SHORTEN_JOB_LEASE, poll_interval=SHORTEN_POLL_INTERVAL):
+        self.collection = collection
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.capacity = workers * 4
+        self.local_ids = set()
+        # Chats with a job in the local queue or running, mapped to their later jobs
+        self._chats = {}
+        self._queue = None
+        self._wakeup = None
+        self._spilled = False
+        self._tasks = []
+
+    # Store a new job and queue it locally; returns False when the local queue is
+    # full and the job waits in Mongo for a free worker
+    async def enqueue(self, job):
+        now = datetime.utcnow()
+        job.update(status='queued', attempts=0, next_attempt_at=now, lease_owner=None, lease_until=None,
+                   created_at=now, updated_at=now)
+        await self.collection.insert_one(job)
+        return self._put(job)
+
+    def _put(self, job):
+        if self._queue is None or job['_id'] in self.local_ids:
+            return False
+        if len(self.local_ids) >= self.capacity:
+            self._spilled = True
+            return False
+        self.local_ids.add(job['_id'])
+        SHORTEN_JOBS_LOCAL.inc()
+        waiting = self._chats.get(job['chat_id'])
+        if waiting is None:
+            self._chats[job['chat_id']] = deque()
+            self._queue.put_nowait(job)
+        else:
+            waiting.append(job)
+        return True
+
+    # Hand the chat's next local job to the workers once its previous one is done
+    def _release(self, job):
+        waiting = self._chats.get(job['chat_id'])
+        if waiting:
+            self._queue.put_nowait(waiting.popleft())
+        else:
+            self._chats.pop(job['chat_id'], None)
+
+    def start(self, bot):
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._poll())]
+        self._tasks.extend(asyncio.create_task(self._worker(bot)) for _ in range(self.workers))
+
+    # Cancel the workers, running jobs are released for another worker or the next start
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Wait until the local queue is drained, including jobs that overflowed into Mongo;
+    # retries that are not due yet are not waited for
+    async def join(self):
+        while True:
+            await self._queue.join()
+            if not self._spilled:
+                return
+            self._wakeup.set()
+            await asyncio.sleep(0.01)
+
+    # Queue due jobs from Mongo every poll_interval, or as soon as the local queue
+    # drains after jobs had to be left in Mongo
+    async def _poll(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._fill()
+            except Exception as e:
+                logger.error(f"Error polling shorten jobs: {e}")
+
+    async def _fill(self):
+        self._spilled = False
+        free = self.capacity - len(self.local_ids)
+        if free <= 0:
+            self._spilled = True
+            return
+        queued = 0
+        async for job in self.collection.iterate(claimable(datetime.utcnow()), sort=[('next_attempt_at', 1)],
+                                                 limit=free + len(self.local_ids), batch_size=free):
+            if job['_id'] in self.local_ids:
+                continue
+            if job['chat_id'] not in self._chats and await self._blocked(job):
+                continue
+            if not self._put(job):
+                break
+            queued += 1
+            if queued >= free:
+                # There may be more, look again once these are done
+                self._spilled = True
+                break
+
+    async def _worker(self, bot):
+        while True:
+            job = await self._queue.get()
+            try:
+                if await self._claim(job):
+                    await self._run(bot, job)
+            except Exception as e:
+                logger.error(f"Error running shorten job {job['_id']}: {e}")
+            finally:
+                self.local_ids.discard(job['_id'])
+                SHORTEN_JOBS_LOCAL.dec()
+                self._release(job)
+                self._queue.task_done()
+                if self._spilled and self._queue.empty():
+                    self._wakeup.set()
+
+    # Whether an older job of the same chat still has to run first
+    async def _blocked(self, job):
+        older = await self.collection.find_one(
+            {'chat_id': job['chat_id'], 'created_at': {'$lt': job['created_at']},
+             'status': {'$in': ['queued', 'running']}},
+            {'_id': 1}
+        )
+        return older is not None
+
+    # Lease the job if nobody ran it since it was read and its chat has no older
+    # job left; a blocked job is dropped here and found again by the poller
+    async def _claim(self, job):
+        if await self._blocked(job):
+            return False
+        now = datetime.utcnow()
+        result = await self.collection.update_one(
+            {'_id': job['_id'], 'attempts': job['attempts'], **claimable(now)},
+            {
+                '$set': {'status': 'running', 'lease_owner': WORKER_ID,
+                         'lease_until': now + timedelta(seconds=self.lease), 'updated_at': now},
+                '$inc': {'attempts': 1},
+            }
+        )
+        if result.matched_count == 0:
+            return False
+        if job['attempts'] == 0:
+            SHORTEN_JOB_DELAY.observe((now - job['created_at']).total_seconds())
+        job['attempts'] += 1
+        return True
+
+    async def _run(self, bot, job):
+        final = job['attempts'] >= self.max_attempts
+        try:
+            await self.handler(bot, job, final)
+        except asyncio.CancelledError:
+            await self._finish(job, {'status': 'queued', 'next_attempt_at': datetime.utcnow(),
+                                     'attempts': job['attempts'] - 1})
+            raise
+        except Exception as e:
+            if not isinstance(e, RetryJob):
+                logger.warning(f"Shorten job {job['_id']} failed on attempt {job['attempts']}: {e}")
+            if final:
+                SHORTEN_JOBS.inc(outcome='failed')
+                await self._finish(job, {'status': 'failed', 'finished_at': datetime.utcnow()})
+            else:
+                SHORTEN_JOBS.inc(outcome='retried')
+                delay = min(self.max_retry_delay, self.retry_delay * 2 ** (job['attempts'] - 1))
+                await self._finish(job, {'status': 'queued',
+                                         'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay)})
+            return
+        SHORTEN_JOBS.inc(outcome='done')
+        await self._finish(job, {'status': 'done', 'finished_at': datetime.utcnow()})
+
+    async def _finish(self, job, fields):
+        await self.collection.update_one(
+            {'_id': job['_id'], 'lease_owner': WORKER_ID, 'attempts': job['attempts']},
+            {'$set': {**fields, 'lease_owner': None, 'lease_until': None, 'updated_at': datetime.utcnow()}}
+        )
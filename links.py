@@ -0,0 +1,69 @@
+import re
+from urllib.parse import urlsplit, parse_qs
+
+from telegram import MessageEntity
+
+
+# Fallback link pattern for messages without entities, trailing punctuation is trimmed
+LINK_RE = re.compile(r"https?://[^\s<>\"']+")
+TRAILING_PUNCTUATION = ".,;:!?)]}>»”’"
+
+# Terabox share key after /s/, e.g. https://www.terabox.com/s/1AbC-d_9 -> 1AbC-d_9
+TERABOX_PATH_RE = re.compile(r"/s/([A-Za-z0-9_-]+)")
+
+LINK_ENTITY_TYPES = (MessageEntity.URL, MessageEntity.TEXT_LINK)
+
+
+# Find http(s) links in plain text
+def find_links(text):
+    return [link.rstrip(TRAILING_PUNCTUATION) for link in LINK_RE.findall(text)]
+
+
+# Canonical Terabox key for a share link on any host variant (terabox.com,
+# 1024terabox.com, teraboxapp.com, ...), or None for other links. Both the
+# /s/<key> and the /sharing/link?surl=<key> forms map to the same key.
+def terabox_key(link):
+    matches = TERABOX_PATH_RE.findall(link)
+    if matches:
+        return matches[-1]
+    if "surl=" not in link:
+        return None
+    surl = parse_qs(urlsplit(link).query).get("surl")
+    if surl and re.fullmatch(r"[A-Za-z0-9_-]+", surl[0]):
+        return "1" + surl[0]
+    return None
+
+
+# Links in a message or caption, in order of appearance and without duplicates.
+# Telegram's url/text_link entities are used first, which also catches hidden
+# links and links written without a scheme; plain text is the fallback.
+def extract_links(message):
+    if message.caption is not None:
+        text, entities = message.caption, message.caption_entities
+    else:
+        text, entities = message.text or "", message.entities
+
+    entities = [entity for entity in entities or () if entity.type in LINK_ENTITY_TYPES]
+    if entities:
+        # Entity offsets count UTF-16 code units, so slice one UTF-16 copy of the text
+        encoded = text.encode("utf-16-le")
+        links = [
+            entity.url if entity.type == MessageEntity.TEXT_LINK
+            else encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode("utf-16-le")
+            for entity in sorted(entities, key=lambda entity: entity.offset)
+        ]
+    else:
+        links = find_links(text)
+    return dedupe_links(links)
+
+
+# Drop repeated links, Terabox links count as repeats when their keys match
+def dedupe_links(links):
+    seen = set()
+    unique = []
+    for link in links:
+        key = terabox_key(link) or link
+        if key not in seen:
+            seen.add(key)
+            unique.append(link)
+    return unique
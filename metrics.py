@@ -0,0 +1,142 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from tracing import traced
+
+
+# Latency buckets in seconds, from fast cache hits to slow upstream calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+# Base for metrics exported in the Prometheus text format
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['counts'][i] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    # Observe the duration of the with-block, also usable around awaits
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for key, series in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, series['counts']):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+# Render every registered metric in the Prometheus text exposition format
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Updates currently being handled", ["handler"])
+HANDLER_LATENCY = Histogram("bot_handler_latency_seconds", "Time spent in update handlers", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Update handlers that raised", ["handler"])
+SHORTENER_LATENCY = Histogram("bot_shortener_latency_seconds", "Latency of shortener API calls")
+SHORTENER_ERRORS = Counter("bot_shortener_errors_total", "Failed shortener API calls", ["reason"])
+MONGO_LATENCY = Histogram("bot_mongo_latency_seconds", "Latency of MongoDB operations", ["collection", "operation"])
+MONGO_ERRORS = Counter("bot_mongo_errors_total", "Failed MongoDB operations", ["collection", "operation"])
+
+
+# Wrap an update handler to track in-flight updates, latency and errors, and trace the update
+def instrumented(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        UPDATES_IN_FLIGHT.inc(handler=name)
+        try:
+            with HANDLER_LATENCY.time(handler=name), traced(name, update):
+                return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            UPDATES_IN_FLIGHT.dec(handler=name)
+
+    return wrapper
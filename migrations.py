@@ -0,0 +1,174 @@
+import logging
+import os
+import sys
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+
+# Load environment variables from .env file, before the modules below read their settings
+load_dotenv()
+
+from db import (mongo, migration_mongo, user_collection, api_collection, user_channels_collection,
+                short_url_collection, broadcast_jobs_collection, update_claims_collection, chat_status_collection,
+                stats_collection, shorten_jobs_collection, schema_collection)
+from cache import SHORT_URL_CACHE_TTL
+from cluster import UPDATE_CLAIM_TTL
+from stats import TOTALS_ID
+from jobs import SHORTEN_JOB_RETENTION
+from channels import WRITABLE
+
+
+logger = logging.getLogger(__name__)
+
+# MIGRATE_ON_START=1 applies pending migrations from the bot itself, for single
+# replica deploys; otherwise run `python migrations.py` once before deploying
+MIGRATE_ON_START = os.getenv("MIGRATE_ON_START", "0") == "1"
+MIGRATION_TIMEOUT = float(os.getenv("MIGRATION_TIMEOUT", "600"))
+
+
+# The pymongo collection behind `collection` on the migration client
+def _sync(collection):
+    return migration_mongo.client[collection.database][collection.name]
+
+
+def _lookup_indexes():
+    _sync(user_collection).create_index([('user_id', 1)], unique=True)
+    _sync(api_collection).create_index([('user_id', 1)], unique=True)
+    _sync(user_channels_collection).create_index([('user_id', 1)], unique=True)
+
+
+def _short_url_indexes():
+    _sync(short_url_collection).create_index([('api_key', 1), ('long_url', 1)], unique=True)
+    _sync(short_url_collection).create_index([('created_at', 1)], expireAfterSeconds=SHORT_URL_CACHE_TTL)
+
+
+def _broadcast_indexes():
+    _sync(broadcast_jobs_collection).create_index([('status', 1), ('lease_until', 1)])
+
+
+def _update_claim_indexes():
+    _sync(update_claims_collection).create_index([('claimed_at', 1)], expireAfterSeconds=UPDATE_CLAIM_TTL)
+
+
+def _chat_status_indexes():
+    _sync(chat_status_collection).create_index([('state', 1)])
+
+
+# Start the /stats totals from the current collection sizes, the bot maintains them from here on
+def _stats_baseline():
+    _sync(stats_collection).update_one(
+        {'_id': TOTALS_ID},
+        {'$set': {
+            'users': _sync(user_collection).count_documents({}),
+            'connected_keys': _sync(api_collection).count_documents({}),
+            'channels': _sync(user_channels_collection).count_documents({'channel_id': {'$exists': True}}),
+        }},
+        upsert=True
+    )
+
+
+def _shorten_job_indexes():
+    _sync(shorten_jobs_collection).create_index([('status', 1), ('next_attempt_at', 1)])
+    _sync(shorten_jobs_collection).create_index([('status', 1), ('lease_until', 1)])
+    _sync(shorten_jobs_collection).create_index([('finished_at', 1)], expireAfterSeconds=SHORTEN_JOB_RETENTION)
+
+
+# Channels were checked when they were registered, start them as writable and
+# due for revalidation; fan-outs read them by state
+def _channel_registry():
+    _sync(user_channels_collection).create_index([('state', 1)])
+    _sync(user_channels_collection).create_index([('channel_id', 1)])
+    _sync(user_channels_collection).create_index([('checked_at', 1)])
+    _sync(user_channels_collection).update_many(
+        {'channel_id': {'$exists': True}, 'state': {'$exists': False}},
+        {'$set': {'state': WRITABLE, 'checked_at': None}}
+    )
+
+
+# Jobs of a chat run in creation order, a job is claimed once no older one is left
+def _shorten_job_order_index():
+    _sync(shorten_jobs_collection).create_index([('chat_id', 1), ('created_at', 1)])
+
+
+# Schema migrations in order; append new ones with the next version number
+MIGRATIONS = [
+    (1, "unique user_id on users, api_id and user_channels", _lookup_indexes),
+    (2, "short url cache lookup and TTL indexes", _short_url_indexes),
+    (3, "broadcast job lease index", _broadcast_indexes),
+    (4, "update claim TTL index", _update_claim_indexes),
+    (5, "chat reachability state index", _chat_status_indexes),
+    (6, "stats totals baseline", _stats_baseline),
+    (7, "shorten job queue and retention indexes", _shorten_job_indexes),
+    (8, "channel registry state and indexes", _channel_registry),
+    (9, "shorten job per-chat order index", _shorten_job_order_index),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+# Last version read from the schema collection, once it is current it is never read again
+_checked_version = None
+
+
+def current_version(schema):
+    doc = schema.find_one({'_id': 'version'})
+    return doc['version'] if doc else 0
+
+
+# Apply every migration newer than the stored version, recording each one as it
+# completes so an interrupted run picks up where it stopped. Blocking.
+def migrate():
+    version = current_version(_sync(schema_collection))
+    for number, description, apply in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"Applying migration {number}: {description}")
+        apply()
+        _sync(schema_collection).update_one(
+            {'_id': 'version'},
+            {'$set': {'version': number, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+        version = number
+    return version
+
+
+# Check at startup that the database has the indexes this version expects.
+# Returns True when it does; a database behind is migrated with
+# MIGRATE_ON_START=1 and reported otherwise, and never stops the bot.
+async def check_schema():
+    global _checked_version
+    if _checked_version == SCHEMA_VERSION:
+        return True
+    try:
+        _checked_version = await mongo.run(lambda: current_version(schema_collection.sync))
+        if _checked_version < SCHEMA_VERSION and MIGRATE_ON_START:
+            try:
+                _checked_version = await migration_mongo.run(migrate, timeout=MIGRATION_TIMEOUT)
+            finally:
+                migration_mongo.close()
+    except Exception as e:
+        logger.error(f"Error checking the database schema version: {e}")
+        return False
+    if _checked_version < SCHEMA_VERSION:
+        logger.warning(f"Database schema is at version {_checked_version} of {SCHEMA_VERSION}, "
+                       f"run `python migrations.py` to create the missing indexes")
+        return False
+    return True
+
+
+# One-shot migration command
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.INFO)
+    try:
+        version = migrate()
+    except Exception as e:
+        logger.error(f"Migration failed: {e}")
+        sys.exit(1)
+    finally:
+        migration_mongo.close()
+    logger.info(f"Database schema is at version {version}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+
+# Token bucket refilled at `rate` tokens per second up to `capacity`.
+# acquire() waits for a token, try_acquire() answers immediately, and
+# pause() blocks the bucket entirely, e.g. after a Telegram RetryAfter, and
+# set_rate() changes the rate, scaling the capacity with it.
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # A bucket must hold at least one token, or a rate below 1 would never grant one
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    def try_acquire(self, tokens=1):
+        now = self._refill()
+        if now < self.blocked_until or self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    async def acquire(self, tokens=1):
+        while True:
+            now = self._refill()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+            elif self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            else:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.capacity = max(1, self.capacity * rate / self.rate)
+        self.tokens = min(self.tokens, self.capacity)
+        self.rate = rate
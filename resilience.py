@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import random
+import time
+
+from metrics import Counter, Gauge
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+CIRCUIT_STATE = Gauge("bot_circuit_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ["circuit"])
+CIRCUIT_TRANSITIONS = Counter("bot_circuit_transitions_total", "Circuit breaker state transitions", ["circuit", "state"])
+RETRIES = Counter("bot_retries_total", "Retried upstream calls", ["call"])
+HEDGES = Counter("bot_hedged_requests_total", "Hedged second requests started", ["call"])
+
+
+# Circuit breaker: after failure_threshold consecutive failures the circuit
+# opens and calls fail fast; after recovery_timeout one trial call is let
+# through (half-open), and its outcome closes or re-opens the circuit.
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        CIRCUIT_STATE.set(STATE_VALUES[CLOSED], circuit=name)
+
+    def _transition(self, state):
+        if state != self.state:
+            logger.warning(f"Circuit {self.name} is now {state}")
+            self.state = state
+            CIRCUIT_STATE.set(STATE_VALUES[state], circuit=self.name)
+            CIRCUIT_TRANSITIONS.inc(circuit=self.name, state=state)
+
+    # Whether a call may go ahead now
+    def allow(self):
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+            self._transition(HALF_OPEN)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_running = False
+        self._transition(CLOSED)
+
+    # The call was cancelled before it had an outcome, free the half-open trial slot
+    def record_cancelled(self):
+        self._trial_running = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._transition(OPEN)
+
+
+# Call fn() up to `attempts` times, sleeping a full-jitter exponential backoff
+# between attempts; only exceptions in retry_on are retried.
+async def retry(fn, attempts, base_delay, max_delay, retry_on, name="call"):
+    for attempt in range(attempts):
+        try:
+            return await fn()
+        except retry_on:
+            if attempt == attempts - 1:
+                raise
+            RETRIES.inc(call=name)
+            await asyncio.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+
+# Call fn(), and if it has not finished after `delay` seconds start a second
+# call; the first successful result wins and the other call is cancelled.
+async def hedged(fn, delay, name="call"):
+    first = asyncio.ensure_future(fn())
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+
+        HEDGES.inc(call=name)
+        pending.add(asyncio.ensure_future(fn()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
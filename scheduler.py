@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from cache import TTLCache
+from metrics import Counter, Gauge, Histogram
+from ratelimit import TokenBucket
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+# Outbound send limits. Telegram allows bots about 30 messages per second overall,
+# about one per second into a private chat and 20 per minute into a group or channel.
+# Bulk sends (broadcasts, channel forwards, rechecks) may use at most SEND_BULK_SHARE
+# of the global rate, so interactive replies always find room.
+SEND_RATE = float(os.getenv("SEND_RATE", "30"))
+SEND_MIN_RATE = float(os.getenv("SEND_MIN_RATE", "5"))
+SEND_BULK_SHARE = float(os.getenv("SEND_BULK_SHARE", "0.8"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", "20")) / 60
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+# After a global flood wait the global rate is halved, and raised again by a tenth
+# of SEND_RATE for every SEND_RECOVERY_INTERVAL seconds without one; all sends are
+# paused for the flood wait, but never longer than SEND_MAX_GLOBAL_PAUSE seconds
+SEND_RECOVERY_INTERVAL = float(os.getenv("SEND_RECOVERY_INTERVAL", "30"))
+SEND_MAX_GLOBAL_PAUSE = float(os.getenv("SEND_MAX_GLOBAL_PAUSE", "5"))
+
+# Priority lanes, passed to bot methods as rate_limit_args; lower goes first
+INTERACTIVE = 0
+BULK = 1
+LANES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+SEND_QUEUED = Gauge("bot_send_queued", "Sends waiting for a global send slot", ["lane"])
+SEND_WAIT = Histogram("bot_send_wait_seconds", "Time sends waited in the scheduler", ["lane"])
+SEND_FLOOD_WAITS = Counter("bot_send_flood_waits_total", "RetryAfter answers from Telegram", ["lane"])
+SEND_RATE_LIMIT = Gauge("bot_send_rate", "Current global send rate in messages per second")
+
+
+# Methods that post into a chat and count against Telegram's message limits; any
+# other call (getMe, getFile, setWebhook...) is passed straight through
+def is_send(endpoint):
+    return endpoint.startswith("send") or endpoint in ("copyMessage", "forwardMessage")
+
+
+# Groups and channels have negative ids, channels can also be addressed by @username
+def is_private(chat_id):
+    return isinstance(chat_id, int) and chat_id > 0
+
+
+# Every Bot API request of the Application goes through this scheduler. A send first
+# takes a token from its chat's bucket, bulk sends also from the bulk bucket, and
+# then waits in a priority queue for a global token: the dispatcher hands each
+# global token to the waiting send with the lowest lane, oldest first, so replies
+# overtake a running broadcast. On RetryAfter the chat's bucket is paused. A
+# group or channel has its own limit, so its flood wait stops only that chat; a
+# flood wait anywhere else means the bot as a whole went too fast, so the global
+# buckets are paused too, for at most max_global_pause, and the global rate is
+# halved, then recovered step by step. The send is retried up to max_retries
+# times before the RetryAfter reaches the caller.
+class SendScheduler(BaseRateLimiter):
+    def __init__(self, rate=SEND_RATE, min_rate=SEND_MIN_RATE, bulk_share=SEND_BULK_SHARE,
+                 chat_rate=SEND_CHAT_RATE, chat_burst=SEND_CHAT_BURST, group_rate=SEND_GROUP_RATE,
+                 max_retries=SEND_MAX_RETRIES, recovery_interval=SEND_RECOVERY_INTERVAL,
+                 max_global_pause=SEND_MAX_GLOBAL_PAUSE):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.bulk_share = bulk_share
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.recovery_interval = recovery_interval
+        self.max_global_pause = max_global_pause
+        self.bucket = TokenBucket(rate)
+        self.bulk_bucket = TokenBucket(rate * bulk_share)
+        self.chat_buckets = TTLCache(maxsize=100000, ttl=3600)
+        self.rate_changed = time.monotonic()
+        self._waiting = []
+        self._order = itertools.count()
+        self._dispatcher = None
+        SEND_RATE_LIMIT.set(rate)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+        for _, _, future in self._waiting:
+            future.cancel()
+        self._waiting.clear()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not is_send(endpoint):
+            return await callback(*args, **kwargs)
+        lane = BULK if rate_limit_args == BULK else INTERACTIVE
+        chat_id = data.get("chat_id")
+        for attempt in range(self.max_retries + 1):
+            with span("send_wait"), SEND_WAIT.time(lane=LANES[lane]):
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                if lane == BULK:
+                    await self.bulk_bucket.acquire()
+                await self._turn(lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                SEND_FLOOD_WAITS.inc(lane=LANES[lane])
+                self._flood(chat_id, e.retry_after)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood limit hit sending to {chat_id}, retrying in {e.retry_after}s "
+                               f"at {self.bucket.rate:.1f} messages per second")
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, capacity=self.chat_burst) if is_private(chat_id) else TokenBucket(self.group_rate, capacity=1)
+            self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    # Wait until the dispatcher hands this send a global token
+    async def _turn(self, lane):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiting, (lane, next(self._order), future))
+        SEND_QUEUED.inc(lane=LANES[lane])
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        finally:
+            SEND_QUEUED.dec(lane=LANES[lane])
+
+    # Runs while sends are waiting; a token taken for a send cancelled meanwhile goes to the next one
+    async def _dispatch(self):
+        try:
+            while self._waiting:
+                self._recover()
+                await self.bucket.acquire()
+                while self._waiting:
+                    _, _, future = heapq.heappop(self._waiting)
+                    if not future.done():
+                        future.set_result(None)
+                        break
+        finally:
+            self._dispatcher = None
+
+    def _flood(self, chat_id, retry_after):
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(retry_after)
+            if not is_private(chat_id):
+                return
+        pause = min(retry_after, self.max_global_pause)
+        self.bucket.pause(pause)
+        self.bulk_bucket.pause(pause)
+        self._set_rate(max(self.min_rate, self.bucket.rate / 2))
+
+    def _recover(self):
+        if self.bucket.rate >= self.max_rate or time.monotonic() - self.rate_changed < self.recovery_interval:
+            return
+        self._set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 10))
+
+    def _set_rate(self, rate):
+        self.bucket.set_rate(rate)
+        self.bulk_bucket.set_rate(rate * self.bulk_share)
+        self.rate_changed = time.monotonic()
+        SEND_RATE_LIMIT.set(rate)
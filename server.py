@@ -0,0 +1,276 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import signal
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from telegram import Update
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# HTTP server settings, the same port serves health checks and the Telegram webhook
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("PORT", "8000"))
+HTTP_IDLE_TIMEOUT = float(os.getenv("HTTP_IDLE_TIMEOUT", "75"))
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY", str(1024 * 1024)))
+READINESS_CHECK_TIMEOUT = float(os.getenv("READINESS_CHECK_TIMEOUT", "3"))
+READINESS_CACHE_TTL = float(os.getenv("READINESS_CACHE_TTL", "10"))
+
+REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        parts = urlsplit(target)
+        self.method = method
+        self.path = parts.path
+        self.query = parse_qs(parts.query)
+        self.headers = headers
+        self.body = body
+
+
+class Response:
+    def __init__(self, status=200, body=b"", content_type="text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body if isinstance(body, bytes) else body.encode()
+        self.content_type = content_type
+
+
+# Minimal asyncio HTTP/1.1 server with keep-alive. Routes map (method, path)
+# to coroutines taking a Request and returning a Response. close() stops
+# accepting connections, drops idle keep-alive connections, answers 503 to any
+# request still arriving and waits for the requests being handled.
+class HttpServer:
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+        self._connections = set()
+        self._idle = set()
+        self._closing = False
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host=HTTP_HOST, port=HTTP_PORT):
+        self._closing = False
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"HTTP server listening on {host}:{port}...")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._closing = True
+        self._server.close()
+        for writer in self._idle:
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while not self._closing:
+                self._idle.add(writer)
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), HTTP_IDLE_TIMEOUT)
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    break
+                if self._closing:
+                    # Not handled, the sender retries it elsewhere or after the restart
+                    await self._write_response(writer, Response(503, "Service Unavailable"), keep_alive=False)
+                    break
+                if isinstance(request, Response):
+                    await self._write_response(writer, request, keep_alive=False)
+                    break
+                response = await self._dispatch(request)
+                keep_alive = request.headers.get("connection", "").lower() != "close"
+                await self._write_response(writer, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"HTTP connection error: {e}")
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    # Read one request, returns None on a closed connection or a Response for a bad request
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            return Response(400, "Bad Request")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length") or 0)
+        if length > HTTP_MAX_BODY:
+            return Response(413, "Payload Too Large")
+        body = await reader.readexactly(length) if length else b""
+        return Request(method, target, headers, body)
+
+    async def _dispatch(self, request):
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return Response(405, "Method Not Allowed")
+            return Response(404, "Not Found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Error handling {request.method} {request.path}: {e}")
+            return Response(500, "Internal Server Error")
+
+    async def _write_response(self, writer, response, keep_alive):
+        head = (
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + response.body)
+        await writer.drain()
+
+
+# Liveness route handler, answers as long as the event loop is running
+async def health(request):
+    return Response(200, "OK")
+
+
+# Readiness route handler running every check concurrently. checks maps a name
+# to a coroutine function returning True when healthy; results are cached for
+# READINESS_CACHE_TTL seconds so frequent probes do not load the dependencies.
+def readiness_handler(checks):
+    cached = {'expires_at': 0.0, 'response': None}
+
+    async def run_check(check):
+        try:
+            return bool(await asyncio.wait_for(check(), READINESS_CHECK_TIMEOUT))
+        except Exception:
+            return False
+
+    async def handle(request):
+        if time.monotonic() < cached['expires_at']:
+            return cached['response']
+        results = await asyncio.gather(*(run_check(check) for check in checks.values()))
+        status = dict(zip(checks, results))
+        response = Response(200 if all(results) else 503, json.dumps(status), "application/json")
+        cached.update(expires_at=time.monotonic() + READINESS_CACHE_TTL, response=response)
+        return response
+
+    return handle
+
+
+# Prometheus metrics route handler
+async def metrics_endpoint(request):
+    return Response(200, metrics.render(), "text/plain; version=0.0.4; charset=utf-8")
+
+
+# Route handler that verifies a secret header and passes the update on.
+# Processing happens in the background, so Telegram gets its 200 straight away.
+# Without a router the update goes to the Application's update queue.
+def webhook_handler(application, secret_token, router=None, header="x-telegram-bot-api-secret-token",
+                    internal=False):
+    async def handle(request):
+        received = request.headers.get(header, "")
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            logger.warning(f"Request to {request.path} with an invalid secret token")
+            return Response(401, "Unauthorized")
+        try:
+            update = Update.de_json(json.loads(request.body), application.bot)
+        except Exception as e:
+            logger.error(f"Invalid webhook payload: {e}")
+            return Response(400, "Bad Request")
+        if router is None:
+            await application.update_queue.put(update)
+        elif internal:
+            await router.accept(update)
+        else:
+            await router.route(update, request.body)
+        return Response(200, "OK")
+
+    return handle
+
+
+# Run the application until SIGINT/SIGTERM. Mirrors the lifecycle of
+# Application.run_polling, including post_init and post_shutdown, with one more
+# step: once updates stop being received, before_stop(application) runs while
+# the Application and its Bot are still up, so work that sends messages in the
+# background can finish or hand its state back before the Bot is closed.
+def _run(application, receive, stop_receiving, before_stop):
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+        await application.initialize()
+        try:
+            if application.post_init:
+                await application.post_init(application)
+            await receive()
+            await application.start()
+            await stop.wait()
+        finally:
+            await stop_receiving()
+            if before_stop is not None:
+                await before_stop(application)
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    asyncio.run(serve())
+
+
+# Run the application in webhook mode. The HTTP server carrying the webhook
+# route is started from post_init and must be closed by before_stop, ahead of
+# the Application, so no update is acknowledged that can no longer be processed.
+def run_webhook(application, webhook_url, secret_token, before_stop=None):
+    async def receive():
+        await application.bot.set_webhook(url=webhook_url, secret_token=secret_token,
+                                          allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Receiving updates by webhook at {webhook_url}")
+
+    async def stop_receiving():
+        pass
+
+    _run(application, receive, stop_receiving, before_stop)
+
+
+# Run the application polling Telegram for updates. On stop the updates already
+# fetched are processed before before_stop runs; the Bot stays up until shutdown.
+def run_polling(application, before_stop=None):
+    async def receive():
+        await application.updater.start_polling()
+
+    async def stop_receiving():
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+
+    _run(application, receive, stop_receiving, before_stop)
@@ -0,0 +1,275 @@
+import abc
+import asyncio
+import logging
+import os
+import random
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from metrics import SHORTENER_LATENCY, SHORTENER_ERRORS
+from resilience import CircuitBreaker, retry, hedged
+from tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+# Shortener backend (see BACKENDS), its API endpoints, e.g. mirrors, as a comma separated
+# list (SHORTENER_API_URL still sets a single one) and how calls are spread over them:
+# "latency" prefers the fastest endpoint recently, "round_robin" takes turns
+SHORTENER_BACKEND = os.getenv("SHORTENER_BACKEND", "bisgram")
+SHORTENER_API_URLS = [
+    url.strip() for url in os.getenv("SHORTENER_API_URLS", os.getenv("SHORTENER_API_URL", "https://bisgram.com/api")).split(",")
+    if url.strip()
+]
+SHORTENER_BALANCE = os.getenv("SHORTENER_BALANCE", "latency")
+# Share of calls sent to a random endpoint under "latency", so the averages of the others stay current
+SHORTENER_EXPLORE = float(os.getenv("SHORTENER_EXPLORE", "0.05"))
+
+# Long-url wrapper used for Terabox links
+TERABOX_WRAPPER_URL = os.getenv("TERABOX_WRAPPER_URL", "https://terabis.blogspot.com/?url=")
+
+# Connection pool and timeout settings for the shared HTTP client
+SHORTENER_MAX_CONNECTIONS = int(os.getenv("SHORTENER_MAX_CONNECTIONS", "100"))
+SHORTENER_MAX_KEEPALIVE = int(os.getenv("SHORTENER_MAX_KEEPALIVE", "20"))
+SHORTENER_TIMEOUT = float(os.getenv("SHORTENER_TIMEOUT", "10"))
+SHORTENER_CONNECT_TIMEOUT = float(os.getenv("SHORTENER_CONNECT_TIMEOUT", "5"))
+
+# Resilience settings: retries with jittered backoff, an optional hedged second
+# request (SHORTENER_HEDGE_DELAY=0 turns it off) and the circuit breaker of every endpoint
+SHORTENER_RETRIES = int(os.getenv("SHORTENER_RETRIES", "2"))
+SHORTENER_RETRY_BASE_DELAY = float(os.getenv("SHORTENER_RETRY_BASE_DELAY", "0.2"))
+SHORTENER_RETRY_MAX_DELAY = float(os.getenv("SHORTENER_RETRY_MAX_DELAY", "2"))
+SHORTENER_HEDGE_DELAY = float(os.getenv("SHORTENER_HEDGE_DELAY", "0"))
+SHORTENER_BREAKER_FAILURES = int(os.getenv("SHORTENER_BREAKER_FAILURES", "5"))
+SHORTENER_BREAKER_RECOVERY = float(os.getenv("SHORTENER_BREAKER_RECOVERY", "30"))
+
+
+class ShortenerError(Exception):
+    pass
+
+
+# The shortener did not give a usable answer (timeout, 5xx, HTML error page)
+class UpstreamError(ShortenerError):
+    pass
+
+
+# The circuit is open, the call was not attempted
+class ShortenerUnavailable(ShortenerError):
+    pass
+
+
+# A shortener API. request() gives the httpx request (method, url, keyword
+# arguments) for one call to an endpoint and parse() turns the decoded JSON answer
+# into the shortened url, or None when the request was rejected.
+class ShortenerBackend(abc.ABC):
+    name = None
+    # Url shortened by validate_api_id to check an api key
+    test_url = "https://example.com"
+
+    # Build the long url for a canonical Terabox key, e.g. abc -> wrapper + abc
+    def long_url(self, key):
+        return TERABOX_WRAPPER_URL + key
+
+    @abc.abstractmethod
+    def request(self, endpoint, api_key, long_url):
+        ...
+
+    @abc.abstractmethod
+    def parse(self, data):
+        ...
+
+
+# A shortener API that also takes several urls in one call: batch_request() gives
+# the request for up to max_batch urls and parse_batch() one result per url, in order
+class BatchShortenerBackend(ShortenerBackend):
+    max_batch = 1
+
+    @abc.abstractmethod
+    def batch_request(self, endpoint, api_key, long_urls):
+        ...
+
+    @abc.abstractmethod
+    def parse_batch(self, data, long_urls):
+        ...
+
+
+# bisgram.com and its mirrors: GET /api?api=KEY&url=URL, one url per call
+class BisgramBackend(ShortenerBackend):
+    name = "bisgram"
+
+    def request(self, endpoint, api_key, long_url):
+        return "GET", endpoint, {"params": {"api": api_key, "url": long_url}}
+
+    def parse(self, data):
+        if isinstance(data, dict) and data.get("status") == "success":
+            return data.get("shortenedUrl")
+        return None
+
+
+BACKENDS = {backend.name: backend for backend in (BisgramBackend,)}
+
+
+# One API endpoint with its own circuit breaker and a moving average of its latency
+class Endpoint:
+    def __init__(self, url, circuit):
+        self.url = url
+        self.breaker = CircuitBreaker(circuit, SHORTENER_BREAKER_FAILURES, SHORTENER_BREAKER_RECOVERY)
+        self.latency = None
+
+    def observe(self, seconds):
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+
+
+# The endpoints of a backend. pick() returns the endpoint for the next call among
+# those whose circuit lets a call through, or None when every circuit is open:
+# "round_robin" takes them in turn, "latency" the lowest moving average, trying
+# each endpoint once first and a random one for an `explore` share of calls. A
+# failed call counts as a timeout-long one, so a failing endpoint is avoided
+# until the others slow down too.
+class EndpointPool:
+    def __init__(self, urls, balance=SHORTENER_BALANCE, explore=SHORTENER_EXPLORE):
+        if balance not in ("latency", "round_robin"):
+            raise ValueError(f"Unknown SHORTENER_BALANCE {balance!r}, use latency or round_robin")
+        self.balance = balance
+        self.explore = explore
+        # A single endpoint keeps the plain "shortener" circuit name
+        self.endpoints = [
+            Endpoint(url, "shortener" if len(urls) == 1 else f"shortener:{urlsplit(url).netloc}") for url in urls
+        ]
+        self._next = 0
+
+    def pick(self):
+        if self.balance == "round_robin":
+            start = self._next
+            self._next = (self._next + 1) % len(self.endpoints)
+            candidates = self.endpoints[start:] + self.endpoints[:start]
+        elif random.random() < self.explore:
+            candidates = random.sample(self.endpoints, len(self.endpoints))
+        else:
+            candidates = sorted(self.endpoints, key=lambda endpoint: -1 if endpoint.latency is None else endpoint.latency)
+        for endpoint in candidates:
+            if endpoint.breaker.allow():
+                return endpoint
+        return None
+
+
+# Non-blocking shortener client sharing one keep-alive connection pool, with
+# per-call timeouts, retries, optional hedging and a circuit breaker per endpoint;
+# retries and hedged requests pick their endpoint again, so they fail over to
+# another one. Requests are built and answers parsed by the backend.
+class ShortenerClient:
+    def __init__(self, backend=None, api_urls=None, balance=SHORTENER_BALANCE):
+        if backend is None:
+            if SHORTENER_BACKEND not in BACKENDS:
+                raise ValueError(f"Unknown SHORTENER_BACKEND {SHORTENER_BACKEND!r}, use one of {', '.join(BACKENDS)}")
+            backend = BACKENDS[SHORTENER_BACKEND]()
+        self.backend = backend
+        self.endpoints = EndpointPool(api_urls or SHORTENER_API_URLS, balance)
+        self._client = None
+
+    # Urls shortened in one call, 1 unless the backend has a multi-url API
+    @property
+    def max_batch(self):
+        return self.backend.max_batch if isinstance(self.backend, BatchShortenerBackend) else 1
+
+    @property
+    def test_url(self):
+        return self.backend.test_url
+
+    def long_url(self, key):
+        return self.backend.long_url(key)
+
+    # Create the pooled client on first use so it binds to the running loop
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(SHORTENER_TIMEOUT, connect=SHORTENER_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=SHORTENER_MAX_CONNECTIONS,
+                    max_keepalive_connections=SHORTENER_MAX_KEEPALIVE,
+                ),
+            )
+        return self._client
+
+    # Shorten a single url. Returns the shortened url, or None when the shortener
+    # rejects the request (e.g. an invalid api key); raises ShortenerError when it
+    # is failing or every circuit is open.
+    async def shorten(self, api_key, long_url):
+        data = await self._resilient(lambda endpoint: self.backend.request(endpoint, api_key, long_url), long_url)
+        shortened_url = self.backend.parse(data)
+        if shortened_url is None:
+            SHORTENER_ERRORS.inc(reason="rejected")
+        return shortened_url
+
+    # Shorten up to max_batch urls in one call of the backend's multi-url API.
+    # Returns one result per url, like shorten(); an answer without exactly one
+    # result per url raises UpstreamError.
+    async def shorten_batch(self, api_key, long_urls):
+        if len(long_urls) > self.max_batch:
+            raise ValueError(f"{len(long_urls)} urls in one call, the backend takes at most {self.max_batch}")
+        data = await self._resilient(
+            lambda endpoint: self.backend.batch_request(endpoint, api_key, long_urls), f"{len(long_urls)} urls"
+        )
+        results = self.backend.parse_batch(data, long_urls)
+        if len(results) != len(long_urls):
+            SHORTENER_ERRORS.inc(reason="bad_response")
+            raise UpstreamError(f"Shortener answered {len(results)} results for {len(long_urls)} urls")
+        SHORTENER_ERRORS.inc(results.count(None), reason="rejected")
+        return results
+
+    async def _resilient(self, build, label):
+        return await retry(
+            lambda: self._attempt(build, label),
+            SHORTENER_RETRIES + 1, SHORTENER_RETRY_BASE_DELAY, SHORTENER_RETRY_MAX_DELAY,
+            retry_on=UpstreamError, name="shortener"
+        )
+
+    async def _attempt(self, build, label):
+        if SHORTENER_HEDGE_DELAY > 0:
+            return await hedged(lambda: self._call(build, label), SHORTENER_HEDGE_DELAY, name="shortener")
+        return await self._call(build, label)
+
+    # One request to the endpoint picked by the pool, guarded by its circuit breaker
+    async def _call(self, build, label):
+        endpoint = self.endpoints.pick()
+        if endpoint is None:
+            SHORTENER_ERRORS.inc(reason="circuit_open")
+            raise ShortenerUnavailable("Shortener circuit is open")
+        method, url, kwargs = build(endpoint.url)
+        started = time.perf_counter()
+        try:
+            with SHORTENER_LATENCY.time(), span("shortener"):
+                response = await asyncio.wait_for(self._get_client().request(method, url, **kwargs), SHORTENER_TIMEOUT)
+            if response.status_code >= 500 or response.status_code == 429:
+                raise UpstreamError(f"HTTP {response.status_code}")
+            data = response.json()
+        except asyncio.CancelledError:
+            endpoint.breaker.record_cancelled()
+            raise
+        except (httpx.HTTPError, asyncio.TimeoutError, UpstreamError, ValueError) as e:
+            SHORTENER_ERRORS.inc(reason="invalid_response" if isinstance(e, ValueError) else "http")
+            endpoint.breaker.record_failure()
+            endpoint.observe(SHORTENER_TIMEOUT)
+            logger.error(f"Error shortening {label} at {endpoint.url}: {e!r}")
+            raise e if isinstance(e, UpstreamError) else UpstreamError(str(e)) from e
+        endpoint.breaker.record_success()
+        endpoint.observe(time.perf_counter() - started)
+        return data
+
+    # Check that the shortener answers at all: any endpoint with a non-5xx response counts as reachable
+    async def ping(self):
+        async def reachable(url):
+            try:
+                response = await self._get_client().get(url, timeout=SHORTENER_CONNECT_TIMEOUT)
+            except httpx.HTTPError:
+                return False
+            return response.status_code < 500
+
+        return any(await asyncio.gather(*(reachable(endpoint.url) for endpoint in self.endpoints.endpoints)))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+
+logger = logging.getLogger(__name__)
+
+# How often counter increments are written to Mongo
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "10"))
+
+TOTALS_ID = 'totals'
+
+
+def today():
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+def day_id(day):
+    return f"day:{day}"
+
+
+# Counters for /stats, kept in one 'totals' document plus one rollup document per
+# UTC day ('day:YYYY-MM-DD'), so figures never need a scan of the user
+# collections. Increments are summed in memory and written with $inc every
+# flush_interval seconds; several workers add to the same documents. Totals
+# such as users are set once by the stats baseline migration and maintained
+# with +1/-1 from then on; the per-day documents hold the change of that day.
+class StatsCounters:
+    def __init__(self, collection, flush_interval=STATS_FLUSH_INTERVAL):
+        self.collection = collection
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self._sources = []
+        self._task = None
+
+    def inc(self, **amounts):
+        counter = self.pending.setdefault(today(), Counter())
+        counter.update({name: amount for name, amount in amounts.items() if amount})
+
+    # Count the growth of read()'s cumulative values, e.g. in-process cache counters
+    def track(self, read):
+        self._sources.append([read, read()])
+
+    def _collect(self):
+        for source in self._sources:
+            current = source[0]()
+            self.inc(**{name: value - source[1].get(name, 0) for name, value in current.items()})
+            source[1] = current
+
+    def start(self):
+        async def loop():
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+
+        self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self):
+        self._collect()
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        totals = Counter()
+        operations = []
+        for day, counter in batch.items():
+            counter = {name: amount for name, amount in counter.items() if amount}
+            if not counter:
+                continue
+            totals.update(counter)
+            operations.append(UpdateOne({'_id': day_id(day)}, {'$inc': counter, '$setOnInsert': {'day': day}}, upsert=True))
+        totals = {name: amount for name, amount in totals.items() if amount}
+        if totals:
+            operations.append(UpdateOne({'_id': TOTALS_ID}, {'$inc': totals}, upsert=True))
+        if not operations:
+            return
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # Put the increments back so the next flush retries them; a partly applied
+            # batch can count twice, which is acceptable for statistics
+            logger.error(f"Error writing stats: {e}")
+            for day, counter in batch.items():
+                self.pending.setdefault(day, Counter()).update(counter)
+
+    # All-time totals and sums over the last 1, 7 and 30 days, after flushing this worker's increments
+    async def report(self):
+        await self.flush()
+        totals = await self.collection.find_one({'_id': TOTALS_ID}) or {}
+        first_day = (datetime.utcnow() - timedelta(days=29)).strftime('%Y-%m-%d')
+        days = {}
+        async for doc in self.collection.iterate({'_id': {'$gte': day_id(first_day), '$lte': day_id(today())}}):
+            days[doc['day']] = doc
+
+        windows = {}
+        for length in (1, 7, 30):
+            start = (datetime.utcnow() - timedelta(days=length - 1)).strftime('%Y-%m-%d')
+            window = Counter()
+            for day, doc in days.items():
+                if day >= start:
+                    window.update({name: value for name, value in doc.items() if isinstance(value, (int, float))})
+            windows[length] = window
+        return {'total': Counter({name: value for name, value in totals.items() if isinstance(value, (int, float))}),
+                'days': windows}
@@ -0,0 +1,138 @@
+import asyncio
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+
+logger = logging.getLogger(__name__)
+
+# Updates taking longer than this many seconds are logged with their spans
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "2"))
+
+# Sampled profiling: the profiler runs for PROFILE_PERIOD * sample rate seconds of every PROFILE_PERIOD
+PROFILE_PERIOD = float(os.getenv("PROFILE_PERIOD", "10"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.1"))
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", "40"))
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+# Time spent per span name while handling one update, as (seconds, count).
+# Spans of concurrent calls overlap, so their sum can exceed the update's time.
+class Trace:
+    def __init__(self, handler, update):
+        self.handler = handler
+        self.update_id = getattr(update, "update_id", None)
+        user = getattr(update, "effective_user", None)
+        self.user_id = user.id if user else None
+        self.started = time.perf_counter()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        total, count = self.spans.get(name, (0.0, 0))
+        self.spans[name] = (total + seconds, count + 1)
+
+    def summary(self):
+        spans = sorted(self.spans.items(), key=lambda item: item[1][0], reverse=True)
+        return ", ".join(f"{name} {total * 1000:.0f}ms x{count}" for name, (total, count) in spans)
+
+
+# Record the time spent in the with-block as a span of the current update, also
+# usable around awaits. Outside an update it does nothing.
+@contextmanager
+def span(name):
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+# Trace the update handled in the with-block, logging it with its spans when it
+# takes SLOW_UPDATE_THRESHOLD seconds or more
+@contextmanager
+def traced(handler, update):
+    trace = Trace(handler, update)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        if elapsed >= SLOW_UPDATE_THRESHOLD:
+            logger.warning(f"Slow update {trace.update_id} ({handler}, user {trace.user_id}) took {elapsed:.2f}s: "
+                           f"{trace.summary() or 'no spans'}")
+
+
+# Bot API request that records every call as a telegram.<method> span
+class TracedRequest(HTTPXRequest):
+    async def do_request(self, url, *args, **kwargs):
+        with span("telegram." + url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, *args, **kwargs)
+
+
+# cProfile of the event loop thread, switched on and off at runtime. To keep the
+# overhead down it only runs for a sample_rate share of every PROFILE_PERIOD;
+# the samples add up in one profile, reported as the hottest functions.
+class SampledProfiler:
+    def __init__(self, period=PROFILE_PERIOD):
+        self.period = period
+        self.sample_rate = None
+        self.started_at = None
+        self._profile = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self, sample_rate=PROFILE_SAMPLE_RATE):
+        if self.running:
+            return
+        self.sample_rate = min(max(sample_rate, 0.01), 1.0)
+        self.started_at = time.monotonic()
+        self._profile = cProfile.Profile()
+
+        async def loop():
+            while True:
+                self._profile.enable()
+                try:
+                    await asyncio.sleep(self.period * self.sample_rate)
+                finally:
+                    self._profile.disable()
+                if self.sample_rate < 1.0:
+                    await asyncio.sleep(self.period * (1 - self.sample_rate))
+
+        self._task = asyncio.create_task(loop())
+
+    # Stop profiling and return the report as text
+    async def stop(self):
+        if not self.running:
+            return None
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+        out = io.StringIO()
+        out.write(f"Profiled {time.monotonic() - self.started_at:.0f}s, sampling {self.sample_rate:.0%} of the time\n")
+        try:
+            stats = pstats.Stats(self._profile, stream=out)
+        except TypeError:
+            out.write("No samples were taken, profile for longer.\n")
+            return out.getvalue()
+        stats.strip_dirs()
+        for order in ("tottime", "cumulative"):
+            out.write(f"\n=== Top {PROFILE_TOP_FUNCTIONS} functions by {order} ===\n")
+            stats.sort_stats(order).print_stats(PROFILE_TOP_FUNCTIONS)
+        return out.getvalue()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+
+from pymongo import UpdateOne
+
+
+logger = logging.getLogger(__name__)
+
+# Write-behind settings for new users
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", "5"))
+USER_FLUSH_BATCH_SIZE = int(os.getenv("USER_FLUSH_BATCH_SIZE", "500"))
+
+
+# Known-user filter in front of the users collection. The set of user ids is
+# warmed from the collection at startup, so /start from a known user costs no
+# write; new users are collected and upserted in periodic bulk_write batches,
+# with a final flush on shutdown. The set is exact rather than a Bloom filter,
+# since a false positive would mean a user is never recorded.
+class KnownUsers:
+    def __init__(self, collection, flush_interval=USER_FLUSH_INTERVAL, batch_size=USER_FLUSH_BATCH_SIZE, stats=None):
+        self.collection = collection
+        self.stats = stats
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.known = set()
+        self.pending = {}
+        self._task = None
+        self._flushing = None
+
+    # Load the known user ids, then flush new users every flush_interval seconds
+    def start(self):
+        async def loop():
+            await self.warm()
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+
+        self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+    async def warm(self):
+        try:
+            async for user in self.collection.iterate({}, {'user_id': 1, '_id': 0}, batch_size=5000):
+                self.known.add(user['user_id'])
+            logger.info(f"Loaded {len(self.known)} known users")
+        except Exception as e:
+            # Unknown ids are upserted again, which is harmless
+            logger.error(f"Error loading known users: {e}")
+
+    # Record a user, only users not seen before are written
+    async def add(self, user_id, username):
+        if user_id in self.known:
+            return
+        self.known.add(user_id)
+        self.pending[user_id] = username
+        if len(self.pending) >= self.batch_size and self._flushing is None:
+            self._flushing = asyncio.create_task(self.flush())
+            self._flushing.add_done_callback(lambda _: setattr(self, '_flushing', None))
+
+    # Forget a user, so the next add() writes it again, e.g. after it was purged
+    def forget(self, user_id):
+        self.known.discard(user_id)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        operations = [
+            UpdateOne({'user_id': user_id}, {'$set': {'user_id': user_id, 'username': username}}, upsert=True)
+            for user_id, username in batch.items()
+        ]
+        try:
+            result = await self.collection.bulk_write(operations, ordered=False)
+            if self.stats is not None:
+                self.stats.inc(users=result.upserted_count)
+        except Exception as e:
+            # Put the batch back so the next flush retries it
+            logger.error(f"Error adding {len(batch)} users: {e}")
+            batch.update(self.pending)
+            self.pending = batch
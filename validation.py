@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import os
+
+from cache import TTLCache
+from shortener import ShortenerError
+
+
+logger = logging.getLogger(__name__)
+
+# API key validation settings: how long valid and invalid results are remembered,
+# how often deferred keys are retried and how many may wait
+API_KEY_VALID_TTL = int(os.getenv("API_KEY_VALID_TTL", str(24 * 3600)))
+API_KEY_INVALID_TTL = int(os.getenv("API_KEY_INVALID_TTL", "300"))
+API_KEY_RECHECK_INTERVAL = float(os.getenv("API_KEY_RECHECK_INTERVAL", "30"))
+API_KEY_MAX_DEFERRED = int(os.getenv("API_KEY_MAX_DEFERRED", "10000"))
+
+
+# Memoized /connect validation. check(api_key) returns True or False, or raises
+# ShortenerError when the key cannot be checked; results are cached per key
+# (invalid ones briefly, so a fixed key is not refused for long) and concurrent
+# checks of one key share one call. Keys that could not be checked are deferred
+# and retried in the background, one at a time so a recovering shortener is not
+# flooded; the deferred queue is in memory and does not survive a restart.
+class ApiKeyValidator:
+    def __init__(self, check, valid_ttl=API_KEY_VALID_TTL, invalid_ttl=API_KEY_INVALID_TTL,
+                 recheck_interval=API_KEY_RECHECK_INTERVAL, max_deferred=API_KEY_MAX_DEFERRED):
+        self.check = check
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.recheck_interval = recheck_interval
+        self.max_deferred = max_deferred
+        self.results = TTLCache(maxsize=100000, ttl=valid_ttl)
+        self.deferred = {}
+        self._pending = {}
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    # Whether api_key is valid, raises ShortenerError when it cannot be checked now
+    async def validate(self, api_key):
+        valid = self.results.get(api_key)
+        if valid is not None:
+            self.hits += 1
+            return valid
+
+        task = self._pending.get(api_key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(api_key))
+            self._pending[api_key] = task
+            task.add_done_callback(lambda _: self._pending.pop(api_key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, api_key):
+        valid = await self.check(api_key)
+        self.results.set(api_key, valid, ttl=self.valid_ttl if valid else self.invalid_ttl)
+        return valid
+
+    # Queue the user's key for a background check, replacing a key the user queued
+    # before. Returns False when the queue is full.
+    def defer(self, user_id, chat_id, api_key):
+        if user_id not in self.deferred and len(self.deferred) >= self.max_deferred:
+            return False
+        self.deferred.pop(user_id, None)
+        self.deferred[user_id] = (chat_id, api_key)
+        return True
+
+    # Drop the user's queued key, e.g. after connecting another one
+    def cancel(self, user_id):
+        self.deferred.pop(user_id, None)
+
+    # Retry deferred keys every recheck_interval seconds; on_result(user_id, chat_id,
+    # api_key, valid) is awaited for every key that could be checked
+    def start(self, on_result):
+        async def loop():
+            while True:
+                await asyncio.sleep(self.recheck_interval)
+                await self.recheck(on_result)
+
+        self._task = asyncio.create_task(loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def recheck(self, on_result):
+        for user_id, (chat_id, api_key) in list(self.deferred.items()):
+            try:
+                valid = await self.validate(api_key)
+            except ShortenerError:
+                # Still unavailable, the remaining keys wait for the next round
+                return
+            except Exception as e:
+                logger.error(f"Error validating deferred API key of {user_id}: {e}")
+                continue
+            # The user may have queued another key or connected one meanwhile
+            if self.deferred.get(user_id) != (chat_id, api_key):
+                continue
+            del self.deferred[user_id]
+            try:
+                await on_result(user_id, chat_id, api_key, valid)
+            except Exception as e:
+                logger.error(f"Error finishing deferred API key validation of {user_id}: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            'deferred': len(self.deferred),
+        }